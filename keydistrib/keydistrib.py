@@ -3,16 +3,33 @@ import red
 from discord.ext import commands
 from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
+from cogs.utils.chat_formatting import box, pagify
 import asyncio
+import csv
+import heapq
 import os
+import shutil
+import sqlite3
+import tempfile
+import time
 import aiohttp
+from collections import Counter, deque
 from random import randint
 from random import choice as randchoice
 from __main__ import send_cmd_help
 
 SETTINGS_PATH = "data/keydistrib/settings.json"
+DB_PATH = "data/keydistrib/keyring.sqlite"
 KEYS_PATH = "data/keydistrib/keys"
+KEYFILE_POLL = 5  # seconds between keyfile checks
+KEYFILE_CHECK_BYTES = 32
+SAVE_DELAY = 2  # seconds of writes to batch into one commit
+BULK_DM_CONCURRENCY = 4
+BULK_PROGRESS_EVERY = 3  # seconds between progress message edits
+DM_RETRIES = 4
 DEFAULT_MSG = "{presenter} gave you a {file} key: {key}"
+DEFAULT_SETTINGS = {"TRANSACTION_TIMEOUT": 24 * 60 * 60,  # seconds
+                    "SHARED_DB": False}
 
 
 #TODO: 1st phase
@@ -44,9 +61,14 @@ DEFAULT_MSG = "{presenter} gave you a {file} key: {key}"
 #TODO: msg tied to each file/key (line override)
 #
 #TODO: option to limit # of keys
-#TODO: update transactions in _update_keys
+#TODO: update transactions in _apply_diff
 #
-#---- settings format -----
+#---- storage -----
+# keyrings, keys and transactions live in DB_PATH (see KeyStore.SCHEMA).
+# settings.json used to hold all of it in the format below.
+# it gets migrated into the db the first time the cog loads
+#
+#---- old settings format -----
 # Diagram: settings->(FILES->filepath->(SERVERS,KEYS->key), USERS->uid)
 # 
 # Actual: 
@@ -87,8 +109,407 @@ class KeyringExists(Exception):
     pass
 
 
+class AlreadyHasKey(Exception):
+    pass
+
+
+class LimitReached(Exception):
+    pass
+
+
+class OfferPending(Exception):
+    pass
+
+
+class KeyStore:
+    """sqlite storage for keyrings, their keys and open transactions
+
+    a key's status is NULL while it's available
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS keyrings (
+            name          TEXT PRIMARY KEY,
+            date_modified REAL,
+            message       TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS keyring_servers (
+            keyring   TEXT NOT NULL,
+            server_id TEXT NOT NULL,
+            PRIMARY KEY (keyring, server_id)
+        );
+        CREATE TABLE IF NOT EXISTS keys (
+            keyring        TEXT NOT NULL,
+            key            TEXT NOT NULL,
+            status         TEXT,
+            date           REAL,
+            recipient_name TEXT,
+            recipient_uid  TEXT,
+            sender_uid     TEXT,
+            server_id      TEXT,
+            PRIMARY KEY (keyring, key)
+        );
+        CREATE INDEX IF NOT EXISTS keys_by_status ON keys (keyring, status);
+        CREATE INDEX IF NOT EXISTS keys_by_recipient
+            ON keys (recipient_uid, keyring);
+        CREATE INDEX IF NOT EXISTS keys_by_date ON keys (keyring, date);
+        CREATE TABLE IF NOT EXISTS transactions (
+            uid       TEXT PRIMARY KEY,
+            server_id TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            sender    TEXT NOT NULL,
+            keyring   TEXT NOT NULL,
+            key       TEXT NOT NULL,
+            created   REAL
+        );
+        CREATE TABLE IF NOT EXISTS server_limits (
+            keyring   TEXT NOT NULL,
+            server_id TEXT NOT NULL,
+            quota     INTEGER,
+            rate      INTEGER,
+            per       REAL,
+            PRIMARY KEY (keyring, server_id)
+        );
+        CREATE TABLE IF NOT EXISTS invite_joins (
+            server_id TEXT NOT NULL,
+            code      TEXT NOT NULL,
+            uid       TEXT NOT NULL,
+            PRIMARY KEY (server_id, code, uid)
+        );
+    """
+
+    INSERT_TRANSACTION = (
+        "INSERT OR REPLACE INTO transactions "
+        "(uid, server_id, sender_id, sender, keyring, key, created) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)")
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # commits only append to the wal and don't fsync, so they're cheap
+        # enough for the event loop. sync() does the fsync in an executor
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(KeyStore.SCHEMA)
+        self._add_column("transactions", "created", "REAL")
+        # keys given out before this was tracked don't count toward quotas
+        self._add_column("keys", "server_id", "TEXT")
+        # offers from before they had a timestamp start their clock now
+        self.conn.execute("UPDATE transactions SET created = ? "
+                          "WHERE created IS NULL", (time.time(),))
+        self.conn.commit()
+
+    def _add_column(self, table, column, kind):
+        columns = [c[1] for c in
+                   self.conn.execute("PRAGMA table_info({})".format(table))]
+        if column not in columns:
+            self.conn.execute("ALTER TABLE {} ADD COLUMN {} {}"
+                              .format(table, column, kind))
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def sync(self):
+        """fsyncs what's been committed. blocking and uses its own
+        connection, so it's meant to run in an executor"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        finally:
+            conn.close()
+
+    # keyrings
+
+    def keyring(self, name):
+        """{"SERVERS", "DATE_MODIFIED", "MESSAGE"} or None"""
+        row = self.conn.execute(
+            "SELECT date_modified, message FROM keyrings WHERE name = ?",
+            (name,)).fetchone()
+        if row is None:
+            return None
+        return {"SERVERS": self.servers(name), "DATE_MODIFIED": row[0],
+                "MESSAGE": row[1]}
+
+    def keyring_names(self):
+        return [n for n, in self.conn.execute("SELECT name FROM keyrings")]
+
+    def new_keyring(self, name, server_id, keys, mtime, message=DEFAULT_MSG):
+        self.conn.execute("INSERT INTO keyrings VALUES (?, ?, ?)",
+                          (name, mtime, message))
+        self.conn.execute("INSERT INTO keyring_servers VALUES (?, ?)",
+                          (name, server_id))
+        self.add_keys(name, keys)
+
+    def servers(self, name):
+        return {sid for sid, in self.conn.execute(
+            "SELECT server_id FROM keyring_servers WHERE keyring = ?", (name,))}
+
+    def keyring_servers(self):
+        """(keyring, server id) for every server a keyring is turned on in"""
+        return self.conn.execute("SELECT keyring, server_id FROM keyring_servers")
+
+    def has_server(self, name, server_id):
+        return self.conn.execute(
+            "SELECT 1 FROM keyring_servers WHERE keyring = ? AND server_id = ?",
+            (name, server_id)).fetchone() is not None
+
+    def toggle_server(self, name, server_id):
+        """returns whether the server can now use the keyring"""
+        if self.has_server(name, server_id):
+            self.conn.execute("DELETE FROM keyring_servers "
+                              "WHERE keyring = ? AND server_id = ?",
+                              (name, server_id))
+            return False
+        self.conn.execute("INSERT INTO keyring_servers VALUES (?, ?)",
+                          (name, server_id))
+        return True
+
+    def set_message(self, name, message):
+        self.conn.execute("UPDATE keyrings SET message = ? WHERE name = ?",
+                          (message, name))
+
+    def set_date_modified(self, name, mtime):
+        self.conn.execute("UPDATE keyrings SET date_modified = ? WHERE name = ?",
+                          (mtime, name))
+
+    # keys
+
+    def key_statuses(self, name):
+        """{key: status} for every key in the keyring"""
+        return dict(self.conn.execute(
+            "SELECT key, status FROM keys WHERE keyring = ?", (name,)))
+
+    def add_keys(self, name, keys):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO keys (keyring, key) VALUES (?, ?)",
+            ((name, k) for k in keys))
+
+    def missing_keys(self, name, keys):
+        """the keys that aren't in the keyring yet"""
+        return [k for k in keys if self.conn.execute(
+            "SELECT 1 FROM keys WHERE keyring = ? AND key = ?",
+            (name, k)).fetchone() is None]
+
+    def remove_keys(self, name, keys):
+        self.conn.executemany("DELETE FROM keys WHERE keyring = ? AND key = ?",
+                              ((name, k) for k in keys))
+
+    def available_keys(self, name):
+        """available keys in file order"""
+        return [k for k, in self.conn.execute(
+            "SELECT key FROM keys WHERE keyring = ? AND status IS NULL "
+            "ORDER BY rowid", (name,))]
+
+    def set_key_info(self, name, key, status, date, recipient_name,
+                     recipient_uid, sender_uid):
+        self.conn.execute(
+            "UPDATE keys SET status = ?, date = ?, recipient_name = ?, "
+            "recipient_uid = ?, sender_uid = ? WHERE keyring = ? AND key = ?",
+            (status, date, recipient_name, recipient_uid, sender_uid,
+             name, key))
+
+    def set_key_server(self, name, key, server_id):
+        self.conn.execute(
+            "UPDATE keys SET server_id = ? WHERE keyring = ? AND key = ?",
+            (server_id, name, key))
+
+    def free_key(self, name, key):
+        self.set_key_info(name, key, None, None, None, None, None)
+        self.set_key_server(name, key, None)
+
+    def claim_key(self, name, uid, recipient_name, t, quota=None):
+        """takes the first free key in a keyring for uid and opens their
+        transaction t in one db transaction, so it's safe with other
+        processes using the same db. returns the key
+
+        blocking and uses its own connection, so it's meant to run in an
+        executor while the loop keeps using self.conn. commit self.conn
+        first or this waits on its write lock
+
+        raises AlreadyHasKey, OfferPending when uid hasn't answered another
+        offer yet, LimitReached when t's server used up its quota
+        or IndexError when out of keys
+        """
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                key = self._claim(conn, name, uid, recipient_name, t, quota)
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        return key
+
+    @staticmethod
+    def _claim(conn, name, uid, recipient_name, t, quota):
+        if conn.execute(
+                "SELECT 1 FROM keys WHERE recipient_uid = ? AND keyring = ?",
+                (uid, name)).fetchone():
+            raise AlreadyHasKey()
+        if conn.execute("SELECT 1 FROM transactions WHERE uid = ?",
+                        (uid,)).fetchone():
+            raise OfferPending()
+        if quota is not None and conn.execute(
+                "SELECT COUNT(*) FROM keys WHERE keyring = ? AND "
+                "server_id = ? AND status IS NOT NULL",
+                (name, t["SERVERID"])).fetchone()[0] >= quota:
+            raise LimitReached("This server has given out all {} of its "
+                               "{} keys".format(quota, name))
+        row = conn.execute(
+            "SELECT key FROM keys WHERE keyring = ? AND status IS NULL "
+            "ORDER BY rowid LIMIT 1", (name,)).fetchone()
+        if row is None:
+            raise IndexError("No available keys. Please add more keys to "
+                             "{} file".format(name))
+        key = t["KEY"] = row[0]
+        conn.execute(
+            "UPDATE keys SET status = 'IN-PROGRESS', date = ?, "
+            "recipient_name = ?, recipient_uid = ?, sender_uid = ?, "
+            "server_id = ? WHERE keyring = ? AND key = ?",
+            (t["CREATED"], recipient_name, uid, t["SENDERID"], t["SERVERID"],
+             name, key))
+        conn.execute(KeyStore.INSERT_TRANSACTION, KeyStore._transaction_row(uid, t))
+        return key
+
+    def key_info(self, name, key):
+        """(status, sender uid, server id) of a key"""
+        return self.conn.execute(
+            "SELECT status, sender_uid, server_id FROM keys "
+            "WHERE keyring = ? AND key = ?",
+            (name, key)).fetchone() or (None, None, None)
+
+    def tallies(self, name=None):
+        """(keyring, sender uid, server id, status, count) for every
+        combination"""
+        query = ("SELECT keyring, sender_uid, server_id, status, COUNT(*) "
+                 "FROM keys {} GROUP BY keyring, sender_uid, server_id, status")
+        if name is None:
+            return self.conn.execute(query.format(""))
+        return self.conn.execute(query.format("WHERE keyring = ?"), (name,))
+
+    def recent(self, name, limit):
+        """the last keys given out, newest first"""
+        return self.conn.execute(
+            "SELECT key, status, date, recipient_name, recipient_uid, sender_uid "
+            "FROM keys WHERE keyring = ? AND date IS NOT NULL "
+            "ORDER BY date DESC LIMIT ?", (name, limit)).fetchall()
+
+    def issue_dates(self, name, server_id, since):
+        """when keys were offered from a server, oldest first"""
+        return [d for d, in self.conn.execute(
+            "SELECT date FROM keys WHERE keyring = ? AND server_id = ? AND "
+            "date > ? ORDER BY date", (name, server_id, since))]
+
+    # quotas and rate limits
+
+    def limits(self):
+        """(keyring, server id, quota, rate, per) for every server with limits"""
+        return self.conn.execute("SELECT * FROM server_limits")
+
+    def set_limits(self, name, server_id, quota, rate, per):
+        if quota is None and rate is None:
+            self.conn.execute("DELETE FROM server_limits "
+                              "WHERE keyring = ? AND server_id = ?",
+                              (name, server_id))
+        else:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO server_limits VALUES (?, ?, ?, ?, ?)",
+                (name, server_id, quota, rate, per))
+
+    def recipients(self, name=None):
+        """(uid, keyring, key) for every issued key"""
+        if name is None:
+            return self.conn.execute(
+                "SELECT recipient_uid, keyring, key FROM keys "
+                "WHERE recipient_uid IS NOT NULL")
+        return self.conn.execute(
+            "SELECT recipient_uid, keyring, key FROM keys "
+            "WHERE keyring = ? AND recipient_uid IS NOT NULL", (name,))
+
+    # transactions
+
+    def transaction(self, uid):
+        """{"SERVERID", "SENDERID", "SENDER", "FILE", "KEY", "CREATED"}
+        or None"""
+        row = self.conn.execute(
+            "SELECT server_id, sender_id, sender, keyring, key, created "
+            "FROM transactions WHERE uid = ?", (uid,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("SERVERID", "SENDERID", "SENDER", "FILE", "KEY",
+                         "CREATED"), row))
+
+    def set_transaction(self, uid, t):
+        self.conn.execute(KeyStore.INSERT_TRANSACTION,
+                          KeyStore._transaction_row(uid, t))
+
+    @staticmethod
+    def _transaction_row(uid, t):
+        return (uid, t["SERVERID"], t["SENDERID"], t["SENDER"], t["FILE"],
+                t["KEY"], t.get("CREATED") or time.time())
+
+    def transaction_times(self):
+        """(uid, created) for every open transaction"""
+        return self.conn.execute("SELECT uid, created FROM transactions")
+
+    def del_transaction(self, uid):
+        self.conn.execute("DELETE FROM transactions WHERE uid = ?", (uid,))
+
+    # invites
+
+    def server_ids(self):
+        """servers that have at least one keyring turned on"""
+        return {sid for sid, in self.conn.execute(
+            "SELECT DISTINCT server_id FROM keyring_servers")}
+
+    def add_invite_join(self, server_id, code, uid):
+        self.conn.execute("INSERT OR IGNORE INTO invite_joins VALUES (?, ?, ?)",
+                          (server_id, code, uid))
+
+    def invite_joins(self, server_id, code):
+        return [uid for uid, in self.conn.execute(
+            "SELECT uid FROM invite_joins WHERE server_id = ? AND code = ?",
+            (server_id, code))]
+
+    def migrate(self, settings):
+        """one-shot import of the old settings.json layout"""
+        with self.conn:
+            for name, keyring in settings.get("FILES", {}).items():
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO keyrings "
+                    "(name, date_modified, message) VALUES (?, ?, ?)",
+                    (name, keyring.get("DATE_MODIFIED"),
+                     keyring.get("MESSAGE", DEFAULT_MSG)))
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO keyring_servers "
+                    "(keyring, server_id) VALUES (?, ?)",
+                    ((name, sid) for sid in keyring.get("SERVERS", [])))
+                for key, info in keyring.get("KEYS", {}).items():
+                    info = info or {}
+                    recipient = info.get("RECIPIENT") or {}
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO keys "
+                        "(keyring, key, status, date, recipient_name, "
+                        "recipient_uid, sender_uid) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (name, key, info.get("STATUS"), info.get("DATE"),
+                         recipient.get("NAME"), recipient.get("UID"),
+                         info.get("SENDER")))
+            for uid, t in settings.get("TRANSACTIONS", {}).items():
+                self.set_transaction(uid, t)
+
+
 class KeyFileName(commands.Converter):
+    """a keyfile's name. "any" converts to None where a command lets
+    the bot pick"""
     def convert(self):
+        if self.argument.lower() == "any":
+            return None
         name = os.path.splitext(self.argument)[0]
         if _name_to_path(name):
             return name
@@ -102,123 +523,320 @@ class KeyDistrib:
     def __init__(self, bot):
         self.bot = bot
         self.settings = dataIO.load_json(SETTINGS_PATH)
+        self.store = KeyStore(DB_PATH)
+        # keyring name -> deque of available keys, in file order
+        self.pools = {}
+        # uid -> {keyring name: key} for every key given out
+        self.users = {}
+        self._index_users()
+        # keyring name -> Counter of key statuses (None is available) and
+        # keyring name -> sender uid -> Counter of statuses, for reports
+        self.counts = {}
+        self.senders = {}
+        # (keyring name, server id) -> keys offered or used from that server
+        self.issued = Counter()
+        self._tally_all()
+        # keyring name -> set of server ids it's turned on in
+        self.servers = {}
+        for name, sid in self.store.keyring_servers():
+            self.servers.setdefault(name, set()).add(sid)
+        # (keyring name, server id) -> {"QUOTA", "RATE", "PER"} and
+        # a deque of offer times inside the rate window
+        self.limits = {}
+        self.recent_offers = {}
+        for name, sid, quota, rate, per in self.store.limits():
+            self._set_limits(name, sid, quota, rate, per)
+        # keyring name -> {"SIG": (inode, size, mtime), "END", "CHECK"}
+        # of the keyfile as of its last read. see _read_keyfile
+        self.watched = {}
+        self._watcher = self.bot.loop.create_task(self.watch_keyfiles())
+        self._saver = None
+        # uid -> future for the answer to their open transaction.
+        # on_message only looks at people in here
+        self.pending = {}
+        # heap of (deadline, uid). deadlines has the current deadline for
+        # each uid so entries for answered offers can just be skipped
+        self.expiry = []
+        self.deadlines = {}
+        self._expiry_wake = self.bot.loop.create_future()
+        for uid, created in self.store.transaction_times():
+            self._await_answer(uid)
+            self._schedule_expiry(uid, created)
+        self._expirer = self.bot.loop.create_task(self.expire_transactions())
+        # keyring name -> asyncio.Lock held while reserving its keys
+        self.locks = {}
+        # server id -> {invite code: uses}, to tell which invite someone used
+        self.invite_uses = {}
+        self.bot.loop.create_task(self.track_invites())
 
     def _save(self):
-        dataIO.save_json(SETTINGS_PATH, self.settings)
+        """commits the store within SAVE_DELAY. writes made in the
+        meantime go out in the same commit"""
+        if self._saver is None or self._saver.done():
+            self._saver = self.bot.loop.create_task(self._save_later())
+
+    async def _save_later(self):
+        try:
+            await asyncio.sleep(SAVE_DELAY)
+            await self._flush()
+        except asyncio.CancelledError:
+            pass
+
+    async def _flush(self):
+        """commits the store now and syncs it to disk off the event loop.
+        await this before a key leaves the bot so it's never handed out twice
+
+        the commit stays on the loop so it can't land halfway through
+        an update the loop is in the middle of
+        """
+        self.store.commit()
+        await self.bot.loop.run_in_executor(None, self.store.sync)
 
-    def _update_file(self, server, keyfile_name=None):
+    async def watch_keyfiles(self):
+        """reloads keyfiles as they change, off the event loop"""
+        await self.bot.wait_until_ready()
+        try:
+            while True:
+                for name in self.store.keyring_names():
+                    try:
+                        await self._update_file(name)
+                    except Exception as e:
+                        print("KeyDistrib: couldn't reload {}: {}".format(name, e))
+                await asyncio.sleep(KEYFILE_POLL)
+        except asyncio.CancelledError:
+            pass
+
+    async def _update_file(self, keyfile_name):
         """Update memory to match keyfile, given its keyfile_name.
 
-        if none given, updates for every keyfile in memory
+        the file is only read when its inode/size/mtime change. if it just
+        grew, only the new lines are read
         """
-        settings = self.settings
+        loop = self.bot.loop
+        name = keyfile_name
+        state = self.watched.get(name)
+        try:
+            path = _name_to_path(name)
+            sig = await loop.run_in_executor(None, _keyfile_sig, path)
+        except FileNotFoundError:
+            # make sure to remove the unused keys, once
+            if state is None or state["SIG"] is not None:
+                self._apply_diff(name, *_diff_keys([], self.store.key_statuses(name)))
+                self._save()
+                self.watched[name] = {"SIG": None, "END": 0, "CHECK": b""}
+            return
+
+        if state is not None and state["SIG"] == sig:
+            if state["END"] >= sig[1]:
+                return
+            # the last line had no newline and hasn't changed since, take it
+            appended, partial = True, True
+        else:
+            # only trust an append if the file grew past where we stopped,
+            # at the end of a line. anything else (same size, shrunk) is an
+            # edit the check bytes can't see, so it's all reread
+            appended = (state is not None and state["SIG"] is not None and
+                        state["SIG"][0] == sig[0] and sig[1] > state["END"] and
+                        state["CHECK"].endswith(b"\n"))
+            partial = False
+
+        result = None
+        if appended:
+            result = await loop.run_in_executor(
+                None, _read_keyfile, path, None, state["END"],
+                state["CHECK"], partial)
+            if result is not None:
+                removed, added, end, check = result
+                added = self.store.missing_keys(name, added)
+        if result is None:  # edited, not appended to. reread it all
+            statuses = self.store.key_statuses(name)
+            removed, added, end, check = await loop.run_in_executor(
+                None, _read_keyfile, path, statuses)
+
+        self._apply_diff(name, removed, added)
+        self.store.set_date_modified(name, sig[2])
+        self._save()
+        self.watched[name] = {"SIG": sig, "END": end, "CHECK": check}
+
+    def _apply_diff(self, keyfile_name, removed, added):
+        """ deletes unused keys that left the keyfile and adds
+        the new ones as available """
+        self.store.remove_keys(keyfile_name, removed)
+        self.store.add_keys(keyfile_name, added)
+        if removed:
+            # rebuilt from the db on the next give
+            self.pools.pop(keyfile_name, None)
+            self._index_users(keyfile_name)
+            self._tally_all(keyfile_name)
+        else:
+            if keyfile_name in self.pools:
+                self.pools[keyfile_name].extend(added)
+            self._tally(keyfile_name, None, None, len(added))
+
+    def _index_users(self, keyfile_name=None):
+        """rebuilds the recipient index from the db, for one keyring or all"""
+        if keyfile_name is None:
+            self.users.clear()
+        else:
+            for uid in list(self.users):
+                keys = self.users[uid]
+                keys.pop(keyfile_name, None)
+                if not keys:
+                    del self.users[uid]
+        for uid, name, key in self.store.recipients(keyfile_name):
+            self.users.setdefault(uid, {})[name] = key
+
+    def _tally(self, keyfile_name, status, sender_id, n=1, server_id=None):
+        self.counts.setdefault(keyfile_name, Counter())[status] += n
+        if sender_id is not None:
+            senders = self.senders.setdefault(keyfile_name, {})
+            senders.setdefault(sender_id, Counter())[status] += n
+        if server_id is not None and status is not None:
+            self.issued[(keyfile_name, server_id)] += n
+
+    def _tally_all(self, keyfile_name=None):
+        """recounts from the db, for one keyring or all"""
+        if keyfile_name is None:
+            self.counts.clear()
+            self.senders.clear()
+        else:
+            self.counts.pop(keyfile_name, None)
+            self.senders.pop(keyfile_name, None)
+            for k in [k for k in self.issued if k[0] == keyfile_name]:
+                del self.issued[k]
         if keyfile_name is None:
-            keyfiles = settings['FILES']
+            self.issued.clear()
+        for name, sender_id, server_id, status, n in self.store.tallies(keyfile_name):
+            self._tally(name, status, sender_id, n, server_id)
+
+    def _set_limits(self, keyfile_name, server_id, quota, rate, per):
+        k = (keyfile_name, server_id)
+        if quota is None and rate is None:
+            self.limits.pop(k, None)
+            self.recent_offers.pop(k, None)
+            return
+        self.limits[k] = {"QUOTA": quota, "RATE": rate, "PER": per}
+        if rate is not None:
+            self.recent_offers[k] = deque(self.store.issue_dates(
+                keyfile_name, server_id, time.time() - per))
         else:
-            keyfiles = {keyfile_name: settings['FILES'][keyfile_name]}
-        for name, keyring in keyfiles.items():
-            # only update the keys if they are available in this server
-            if server.id not in keyring['SERVERS']:
+            self.recent_offers.pop(k, None)
+
+    def _check_limits(self, keyfile_name, server_id, now):
+        """raises LimitReached if a server can't offer another key right now"""
+        k = (keyfile_name, server_id)
+        limits = self.limits.get(k)
+        if limits is None:
+            return
+        if limits["QUOTA"] is not None and self.issued[k] >= limits["QUOTA"]:
+            raise LimitReached("This server has given out all {} of its {} keys"
+                               .format(limits["QUOTA"], keyfile_name))
+        if limits["RATE"] is not None:
+            offers = self.recent_offers[k]
+            while offers and offers[0] <= now - limits["PER"]:
+                offers.popleft()
+            if len(offers) >= limits["RATE"]:
+                wait = offers[0] + limits["PER"] - now
+                raise LimitReached("This server can only offer {} {} keys every "
+                                   "{:g} minutes. Try again in {:.0f} minutes"
+                                   .format(limits["RATE"], keyfile_name,
+                                           limits["PER"] / 60, wait / 60 + 0.5))
+
+    def _pick_keyrings(self, server):
+        """keyrings turned on in this server that could give a key right now"""
+        now = time.time()
+        names = []
+        for name in sorted(self.servers):
+            if server.id not in self.servers[name] or not self._pool(name):
                 continue
             try:
-                path = _name_to_path(name)
-            except FileNotFoundError as e:
-                # if it was a bogus name, just quit
-                # if name not in settings['FILES']:
-                #     raise e
-                # actually, it'll raise a keyerror before this
-
-                # otherwise, make sure to remove the unused keys
-                # I guess for now this will keep running until a file
-                # gets added. change that later
-                self._update_keys(name)
-                self._save()
-            else:
-                mtime = os.path.getmtime(path)
-                # if mtime is different, we update.
-                # what if our mtime is newer than file's?
-                #TODO: prompt user?
-                # even if our memory is newer than the file at the path now, 
-                # still update (to remove the unused keys)
-                if mtime != keyring["DATE_MODIFIED"]:
-                    # removes non-existing unused keys
-                    # adds new keys
-                    #TODO: write this
-                    self._update_keys(name)
-                    self._save()
-            #TODO: tell user it's done
-
-    def _update_keys(self, keyfile_name):
-        """ deletes unused keys in settings. 
-        Otherwise, if it is a newly added key to the
-        keys file, it initializes it to None. """
-        keys_in_settings = self.settings["FILES"][keyfile_name]["KEYS"]
-        keys = self._get_keys_from_file(keyfile_name)
-        keys_difference = set(keys_in_settings).symmetric_difference(set(keys))
-        for key in keys_difference:
-            if key in keys_in_settings:
-                if keys_in_settings[key] is None:
-                    del keys_in_settings[key]
-                elif keys_in_settings[key]["STATUS"] != "USED":
-                    del keys_in_settings[key]
-            else:  # add it
-                keys_in_settings[key] = None
+                self._check_limits(name, server.id, now)
+            except LimitReached:
+                continue
+            names.append(name)
+        return names
+
+    def user_keys(self, uid):
+        """{keyring name: key} given to a user"""
+        return self.users.get(uid, {})
+
+    def _pool(self, keyfile_name):
+        """free keys for a keyring. loaded from the db the first time"""
+        try:
+            return self.pools[keyfile_name]
+        except KeyError:
+            pool = deque(self.store.available_keys(keyfile_name))
+            self.pools[keyfile_name] = pool
+            return pool
+
+    def _take_key(self, keyfile_name, key):
+        """removes a key from its keyring's pool. it's usually the first one"""
+        pool = self._pool(keyfile_name)
+        if pool and pool[0] == key:
+            pool.popleft()
+        else:
+            try:
+                pool.remove(key)
+            except ValueError:
+                pass
+
+    def _return_key(self, keyfile_name, key, recipient_id):
+        """puts a declined key back at the front of the pool"""
+        status, sender_id, server_id = self.store.key_info(keyfile_name, key)
+        self._tally(keyfile_name, status, sender_id, -1, server_id)
+        self._tally(keyfile_name, None, None)
+        self.store.free_key(keyfile_name, key)
+        keys = self.users.get(recipient_id, {})
+        if keys.get(keyfile_name) == key:
+            del keys[keyfile_name]
+            if not keys:
+                del self.users[recipient_id]
+        if keyfile_name in self.pools:
+            self.pools[keyfile_name].appendleft(key)
 
     def _update_key_info(self, used, keyfile_name, recipient, recipient_id, sender_id, key):
         """ updates information about the specified key after a
         give_key() instance. """
-        self.settings["FILES"][keyfile_name]["KEYS"][key] = {}
-        key_info = self.settings["FILES"][keyfile_name]["KEYS"][key]
-        if used:
-            key_info["STATUS"] = "USED"
-        else:
-            key_info["STATUS"] = "IN-PROGRESS"
-        key_info["DATE"] = os.path.getmtime(_name_to_path(keyfile_name))
-        key_info["RECIPIENT"] = {}
-        key_info["RECIPIENT"]["NAME"] = recipient
-        key_info["RECIPIENT"]["UID"] = recipient_id
-        key_info["SENDER"] = sender_id
+        status = "USED" if used else "IN-PROGRESS"
+        self.users.setdefault(recipient_id, {})[keyfile_name] = key
+        old_status, old_sender, server_id = self.store.key_info(keyfile_name, key)
+        if old_status is None:  # only free keys are still in the pool
+            self._take_key(keyfile_name, key)
+        self._tally(keyfile_name, old_status, old_sender, -1, server_id)
+        self._tally(keyfile_name, status, sender_id, 1, server_id)
+        self.store.set_key_info(keyfile_name, key, status, time.time(), recipient,
+                                recipient_id, sender_id)
         self._save()
 
 
     def _get_key(self, name, server):
         """ retrieves an available key within the settings file. 
         Raises KeyError if not allowed or no keys available."""
-        self._update_file(server, name)
         if not self._can_get_key(name, server):
             raise KeyError("The {} keyfile isn't turned on in this server."
                            .format(name))
-        keys = self.settings["FILES"][name]["KEYS"]
-        for key, meta in keys.items():
-            if meta is None:
-                return key
-        raise IndexError("No available keys. Please add more keys to {} file".format(name))
+        pool = self._pool(name)
+        if not pool:
+            raise IndexError("No available keys. Please add more keys to {} file".format(name))
+        return pool[0]
 
     def _can_get_key(self, name, server):
         """whether or not a keyfile is accessible to this server"""
-        try:
-            keyring = self.settings['FILES'][name]
-        except:
-            return False
-        return server.id in keyring['SERVERS']
+        return server.id in self.servers.get(name, ())
 
     def new_keyring(self, server, keyfile_name):
-        if keyfile_name in self.settings["FILES"]:
+        if self.store.keyring(keyfile_name) is not None:
             raise KeyringExists('{} is already registered as a keyring'
                                 .format(keyfile_name))
         keys = self._get_keys_from_file(keyfile_name)
         path = _name_to_path(keyfile_name)
         mtime = os.path.getmtime(path)
 
-        keyring = self.settings["FILES"].setdefault(keyfile_name, {
-            "SERVERS": [server.id],
-            "KEYS": {k: None for k in keys},
-            "DATE_MODIFIED": mtime,
-            "MESSAGE": DEFAULT_MSG
-        })
-
+        self.store.new_keyring(keyfile_name, server.id, keys, mtime)
+        self.servers[keyfile_name] = {server.id}
+        self._tally_all(keyfile_name)
         self._save()
-        return keyring
+        return self.store.keyring(keyfile_name)
 
     def _get_keys_from_file(self, keyfile_name):
         path = _name_to_path(keyfile_name)
@@ -226,29 +844,79 @@ class KeyDistrib:
             contents = f.read()
         return list(filter(None, contents.splitlines()))
 
-    def _generate_key_msg(self, presenter, file, key):
+    def _generate_key_msg(self, presenter, file, key, template=None):
         """
         generates the msg to send to the recipient
         given the presenter, file, and key
 
         doesn't check if server is allowed to generate a key"""
-        return (self.settings['FILES'][file]['MESSAGE']
-                .format(presenter=presenter, file=file, key=key))
+        if template is None:
+            template = self.store.keyring(file)['MESSAGE']
+        return template.format(presenter=presenter, file=file, key=key)
 
     def check_repeat(self, user, file):
         """ checks if user received a key already in the past from the keyfile """
-        keydata = self.settings["FILES"][file]["KEYS"]
-        for key in keydata:
-            if keydata[key] is None:
-                continue
-            elif keydata[key]["RECIPIENT"]["UID"] == user.id:
-                return True
-        return False
+        return file in self.users.get(user.id, ())
 
     def _del_transact(self, user_id):
-        del self.settings["TRANSACTIONS"][user_id]
+        self.store.del_transaction(user_id)
+        self.deadlines.pop(user_id, None)
         self._save()
 
+    def _schedule_expiry(self, user_id, created):
+        deadline = created + self.settings["TRANSACTION_TIMEOUT"]
+        self.deadlines[user_id] = deadline
+        heapq.heappush(self.expiry, (deadline, user_id))
+        if self.expiry[0][1] == user_id and not self._expiry_wake.done():
+            self._expiry_wake.set_result(None)  # it's the new soonest
+
+    def _reschedule_expiry(self):
+        """rebuilds the heap, after the timeout changed"""
+        self.expiry.clear()
+        self.deadlines.clear()
+        for uid, created in self.store.transaction_times():
+            self._schedule_expiry(uid, created)
+
+    async def expire_transactions(self):
+        """takes back keys from offers nobody answered in time"""
+        await self.bot.wait_until_ready()
+        try:
+            while True:
+                self._expiry_wake = self.bot.loop.create_future()
+                while self.expiry and self.expiry[0][0] <= time.time():
+                    deadline, uid = heapq.heappop(self.expiry)
+                    if self.deadlines.get(uid) != deadline:
+                        continue  # answered or rescheduled
+                    try:
+                        await self._expire(uid)
+                    except Exception as e:
+                        print("KeyDistrib: couldn't expire the offer to {}: {}"
+                              .format(uid, e))
+                delay = None
+                if self.expiry:
+                    delay = max(0, self.expiry[0][0] - time.time())
+                try:
+                    await asyncio.wait_for(self._expiry_wake, delay)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            pass
+
+    async def _expire(self, user_id):
+        data = self._cancel_offer(user_id)
+        if data is None:
+            return
+        server = self.bot.get_server(data["SERVERID"])
+        if server is None:
+            return
+        sender = server.get_member(data["SENDERID"])
+        recipient = server.get_member(user_id)
+        if sender is not None:
+            name = recipient.display_name if recipient else user_id
+            await self.bot.send_message(sender, "{} didn't answer your {} key "
+                                        "offer in time. The key went back "
+                                        "in the pool".format(name, data["FILE"]))
+
     @checks.admin_or_permissions()
     @commands.group(pass_context=True, no_pm=True)
     async def distribset(self, ctx):
@@ -261,20 +929,20 @@ class KeyDistrib:
     async def distribset_toggle(self, ctx, name: KeyFileName):
         """Toggle availability of a key file in this server"""
         server = ctx.message.server
+        if name is None:
+            return await self.bot.say("Name a keyfile to toggle")
 
-        try:
-            keyring = self.settings["FILES"][name]
-        except KeyError:  # keyring doesn't exist. this is a new file
-            keyring = self.new_keyring(server, name)
+        if self.store.keyring(name) is None:  # this is a new file
+            self.new_keyring(server, name)
             return await self.bot.reply("New keyfile, {}, added. Keys from that file "
                                         "can now be distributed in this server"
                                         .format(name))
-        try:
-            keyring["SERVERS"].remove(server.id)
-            msg = "Keys from that file can no longer be distributed in this server"
-        except ValueError:
-            keyring["SERVERS"].append(server.id)
+        if self.store.toggle_server(name, server.id):
+            self.servers.setdefault(name, set()).add(server.id)
             msg = "Keys from that file can now be distributed in this server"
+        else:
+            self.servers[name].discard(server.id)
+            msg = "Keys from that file can no longer be distributed in this server"
 
         self._save()
         await self.bot.reply(msg)
@@ -292,30 +960,186 @@ class KeyDistrib:
                                       "generate keys for that keyfile")
 
         msg = msg or DEFAULT_MSG
-        keyring = self.settings['FILES'][name]
 
-        keyring["MESSAGE"], oldmsg = msg, keyring["MESSAGE"]
-
-        if msg is None:
-            msg = self._generate_key_msg(author, name, "1TEST2THIS3IS4A5FAKE6KEY")
-        await self.bot.say(msg)
+        await self.bot.say(self._generate_key_msg(author.display_name, name,
+                                                  "1TEST2THIS3IS4A5FAKE6KEY",
+                                                  template=msg))
         await self.bot.say("**^ This is what the user will receive. "
                            "Is this what you want? (yes/no)**")
 
         answer = await self.bot.wait_for_message(timeout=60, author=author, channel=channel)
         if answer and answer.content.lower()[0] == 'y':
-            await self.bot.say("Message set for {}".format(name))
+            self.store.set_message(name, msg)
             self._save()
+            await self.bot.say("Message set for {}".format(name))
         else:
-            keyring["MESSAGE"] = oldmsg
             msg = "Message unchanged" if answer else "No response.. Message unchanged"
             await self.bot.say(msg)
 
+    @checks.is_owner()
+    @distribset.command(pass_context=True, name="timeout")
+    async def distribset_timeout(self, ctx, hours: float):
+        """Set how long a member has to accept a key before it goes back in the pool"""
+        if hours <= 0:
+            return await self.bot.say("The timeout has to be more than 0 hours")
+        self.settings["TRANSACTION_TIMEOUT"] = hours * 60 * 60
+        dataIO.save_json(SETTINGS_PATH, self.settings)
+        self._reschedule_expiry()
+        if not self._expiry_wake.done():
+            self._expiry_wake.set_result(None)
+        await self.bot.say("Key offers now expire after {} hours".format(hours))
+
+    @distribset.command(pass_context=True, name="quota", no_pm=True)
+    async def distribset_quota(self, ctx, name: KeyFileName, keys: int=0):
+        """Limit how many keys from a keyfile this server can give out
+
+        0 removes the limit"""
+        server = ctx.message.server
+        if name is None or not self._can_get_key(name, server):
+            return await self.bot.say("This server isn't allowed to "
+                                      "generate keys for that keyfile")
+        limits = self.limits.get((name, server.id), {})
+        quota = keys if keys > 0 else None
+        self.store.set_limits(name, server.id, quota, limits.get("RATE"),
+                              limits.get("PER"))
+        self._set_limits(name, server.id, quota, limits.get("RATE"),
+                         limits.get("PER"))
+        self._save()
+        if quota is None:
+            await self.bot.say("No limit on {} keys in this server".format(name))
+        else:
+            await self.bot.say("This server can give out {} {} keys. {} given "
+                               "so far".format(quota, name,
+                                               self.issued[(name, server.id)]))
+
+    @distribset.command(pass_context=True, name="rate", no_pm=True)
+    async def distribset_rate(self, ctx, name: KeyFileName, keys: int=0, minutes: float=60):
+        """Limit how many keys from a keyfile this server can offer per so many minutes
+
+        0 keys removes the limit"""
+        server = ctx.message.server
+        if name is None or not self._can_get_key(name, server):
+            return await self.bot.say("This server isn't allowed to "
+                                      "generate keys for that keyfile")
+        if keys > 0 and minutes <= 0:
+            return await self.bot.say("The time has to be more than 0 minutes")
+        limits = self.limits.get((name, server.id), {})
+        rate, per = (keys, minutes * 60) if keys > 0 else (None, None)
+        self.store.set_limits(name, server.id, limits.get("QUOTA"), rate, per)
+        self._set_limits(name, server.id, limits.get("QUOTA"), rate, per)
+        self._save()
+        if rate is None:
+            await self.bot.say("No rate limit on {} keys in this server".format(name))
+        else:
+            await self.bot.say("This server can offer {} {} keys every {:g} minutes"
+                               .format(rate, name, minutes))
+
+    @checks.is_owner()
+    @distribset.command(pass_context=True, name="shared")
+    async def distribset_shared(self, ctx):
+        """Toggle claiming keys straight from the db
+
+        turn this on if more than one bot process shares this data folder.
+        every give then locks the db instead of trusting this process's pool"""
+        self.settings["SHARED_DB"] = not self.settings["SHARED_DB"]
+        dataIO.save_json(SETTINGS_PATH, self.settings)
+        if self.settings["SHARED_DB"]:
+            await self.bot.say("Keys are now claimed through the db")
+        else:
+            await self.bot.say("Keys are now handed out from memory")
+
+
+    def _lock(self, keyfile_name):
+        try:
+            return self.locks[keyfile_name]
+        except KeyError:
+            lock = self.locks[keyfile_name] = asyncio.Lock()
+            return lock
+
+    async def _reserve_key(self, server, sender, user, name):
+        """offers user the next key in a keyring and opens their transaction.
+        only call with the keyring's lock held.
+        returns when the transaction started
+
+        raises AlreadyHasKey, OfferPending when the user hasn't answered
+        another offer yet (they only get one at a time),
+        LimitReached or IndexError when out of keys
+        """
+        now = time.time()
+        if not self._can_get_key(name, server):
+            raise KeyError("The {} keyfile isn't turned on in this server."
+                           .format(name))
+        self._check_limits(name, server.id, now)
+        transaction = {
+            "SERVERID": server.id,
+            "SENDERID": sender.id,
+            "SENDER": sender.display_name,
+            "FILE": name,
+            "CREATED": now
+        }
+        if self.settings["SHARED_DB"]:
+            # the pool and indexes may be stale, let the db decide
+            quota = self.limits.get((name, server.id), {}).get("QUOTA")
+            self.store.commit()  # so claim_key doesn't wait on our lock
+            key = await self.bot.loop.run_in_executor(
+                None, self.store.claim_key, name, user.id, user.display_name,
+                transaction, quota)
+            self._take_key(name, key)
+            self.users.setdefault(user.id, {})[name] = key
+            self._tally(name, None, None, n=-1)
+            self._tally(name, "IN-PROGRESS", sender.id, 1, server.id)
+        else:
+            if self.check_repeat(user, name):
+                raise AlreadyHasKey()
+            if self.store.transaction(user.id) is not None:
+                raise OfferPending()
+            key = transaction["KEY"] = self._get_key(name, server)
+            self.store.set_key_server(name, key, server.id)
+            self._update_key_info(False, name, user.display_name, user.id,
+                                  sender.id, key)
+            self.store.set_transaction(user.id, transaction)
+        if (name, server.id) in self.recent_offers:
+            self.recent_offers[(name, server.id)].append(now)
+        return now
+
+    def _start_offer(self, user_id, created):
+        self._await_answer(user_id)
+        self._schedule_expiry(user_id, created)
+
+    def _cancel_offer(self, user_id):
+        """closes a user's transaction and puts its key back in the pool.
+        returns the transaction, or None if there wasn't one"""
+        data = self.store.transaction(user_id)
+        answer = self.pending.pop(user_id, None)
+        if answer is not None:
+            answer.cancel()
+        self.deadlines.pop(user_id, None)
+        if data is not None:
+            self._return_key(data["FILE"], data["KEY"], user_id)
+            self._del_transact(user_id)
+        return data
+
+    async def _send_dm(self, user, msg):
+        """send_message that backs off and retries when rate limited"""
+        for attempt in range(DM_RETRIES):
+            try:
+                return await self.bot.send_message(user, msg)
+            except discord.HTTPException as e:
+                if e.response.status != 429 or attempt == DM_RETRIES - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    def _offer_msg(self, sender, server, name):
+        return ("{} in the {} server is giving you a {} key. Accept it?(yes/no)"
+                .format(sender.display_name, server.name, name))
 
     @checks.mod_or_permissions()
     @commands.command(pass_context=True, no_pm=True)
     async def give_key(self, ctx, name: KeyFileName, user: discord.Member):
-        """ opens a transaction to give a key to a member """
+        """ opens a transaction to give a key to a member
+
+        use any as the keyfile to give from the first one in this server
+        that has keys left and isn't over its limits"""
         server = ctx.message.server
         channel = ctx.message.channel
         author = ctx.message.author
@@ -323,63 +1147,325 @@ class KeyDistrib:
         if author is user:
             return await self.bot.say("What are you doing :neutral_face:")
 
-        if self.check_repeat(user, name):
-            return await self.bot.say("{} received a key already!".format(user.display_name))
-        
+        names = [name] if name else self._pick_keyrings(server)
+        if not names:
+            return await self.bot.say("No keyfile in this server can give "
+                                      "out a key right now")
+        for i, name in enumerate(names):
+            try:
+                async with self._lock(name):
+                    created = await self._reserve_key(server, author, user, name)
+                    await self._flush()
+                break
+            except AlreadyHasKey:
+                if i + 1 == len(names):
+                    return await self.bot.say("{} received a key already!"
+                                              .format(user.display_name))
+            except OfferPending:
+                return await self.bot.say("{} hasn't answered their last key "
+                                          "offer yet".format(user.display_name))
+            except (IndexError, LimitReached) as e:
+                if i + 1 == len(names):
+                    return await self.bot.say(str(e))
+        self._start_offer(user.id, created)
+
         try:
-            key = self._get_key(name, server)
-        except IndexError as e:
-            return await self.bot.say(str(e))
-        self._update_key_info(False, name, user.display_name, user.id, author.id, key)
+            await self._send_dm(user, self._offer_msg(author, server, name))
+        except discord.HTTPException:
+            self._cancel_offer(user.id)
+            return await self.bot.say("Couldn't message {}. Their key went back "
+                                      "in the pool".format(user.display_name))
+        await self.bot.say("Confirmation prompt sent to {}".format(user.display_name))
 
+    @checks.mod_or_permissions()
+    @commands.group(pass_context=True, no_pm=True)
+    async def give_keys(self, ctx):
+        """Offer keys to a lot of members at once"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
 
-        transaction = self.settings["TRANSACTIONS"].setdefault(user.id, {})
-        
-        transaction["SERVERID"] = server.id
-        transaction["SENDERID"] = author.id
-        transaction["SENDER"] = author.display_name
-        transaction["FILE"] = name
-        transaction["KEY"] = key
+    @give_keys.command(pass_context=True, name="role", no_pm=True)
+    async def give_keys_role(self, ctx, name: KeyFileName, *, role: discord.Role):
+        """Offer a key to everyone with a role"""
+        members = [m for m in ctx.message.server.members if role in m.roles]
+        await self._give_keys(ctx, name, members)
 
-        self._save()
+    @give_keys.command(pass_context=True, name="members", no_pm=True)
+    async def give_keys_members(self, ctx, name: KeyFileName, *members: discord.Member):
+        """Offer a key to each member mentioned"""
+        await self._give_keys(ctx, name, members)
 
-        
-        
-        #TODO: send user confirmation prompt
-        message = await self.bot.send_message(user, "{} in the {} server is giving you a "
-                                        "{} key. Accept it?(yes/no)"
-                                        .format(author.display_name, server.name, name))
-        await self.bot.say("Confirmation prompt sent to {}".format(user.display_name))
+    @give_keys.command(pass_context=True, name="invite", no_pm=True)
+    async def give_keys_invite(self, ctx, name: KeyFileName, invite: str):
+        """Offer a key to everyone who joined through an invite
 
+        only joins while the bot was running and able to see
+        the server's invites are known"""
+        server = ctx.message.server
+        code = invite.rstrip("/").rsplit("/", 1)[-1]
+        members = [server.get_member(uid)
+                   for uid in self.store.invite_joins(server.id, code)]
+        await self._give_keys(ctx, name, [m for m in members if m is not None])
 
+    async def _give_keys(self, ctx, name, members):
+        """reserves keys for every member in one go, then sends
+        the offers a few at a time"""
+        server = ctx.message.server
+        author = ctx.message.author
+        if name is None:
+            return await self.bot.say("Bulk gives need a keyfile")
+        if not self._can_get_key(name, server):
+            return await self.bot.say("This server isn't allowed to "
+                                      "generate keys for that keyfile")
 
-    async def on_message(self, message):
+        failed = []  # (member, reason)
+        recipients = []
+        seen = set()
+        for member in members:
+            if member.id in seen or member.bot or member is author:
+                continue
+            seen.add(member.id)
+            if self.check_repeat(member, name):
+                failed.append((member, "already got a key"))
+            elif member.id in self.pending:
+                failed.append((member, "has a pending offer"))
+            else:
+                recipients.append(member)
+        if not recipients and not failed:
+            return await self.bot.say("Nobody to give keys to")
+
+        created = {}
+        async with self._lock(name):
+            for i, member in enumerate(recipients):
+                try:
+                    created[member.id] = await self._reserve_key(
+                        server, author, member, name)
+                except AlreadyHasKey:
+                    failed.append((member, "already got a key"))
+                except OfferPending:
+                    failed.append((member, "has a pending offer"))
+                except IndexError:
+                    failed.extend((m, "no keys left") for m in recipients[i:])
+                    break
+                except LimitReached:
+                    failed.extend((m, "over this server's limit")
+                                  for m in recipients[i:])
+                    break
+            await self._flush()
+        recipients = [m for m in recipients if m.id in created]
+        for member in recipients:
+            self._start_offer(member.id, created[member.id])
+
+        total = len(recipients)
+        progress = {"DONE": 0, "SENT": 0, "EDITED": time.time()}
+        status = await self.bot.say("Sending {} key offers...".format(total))
+        sem = asyncio.Semaphore(BULK_DM_CONCURRENCY)
+
+        async def offer(member):
+            async with sem:
+                try:
+                    await self._send_dm(member, self._offer_msg(author, server, name))
+                    progress["SENT"] += 1
+                except discord.HTTPException as e:
+                    self._cancel_offer(member.id)
+                    failed.append((member, "couldn't DM ({})".format(e.response.status)))
+            progress["DONE"] += 1
+            if time.time() - progress["EDITED"] >= BULK_PROGRESS_EVERY:
+                progress["EDITED"] = time.time()
+                await self.bot.edit_message(status, "Sending key offers... {}/{}"
+                                            .format(progress["DONE"], total))
+
+        await asyncio.gather(*[offer(m) for m in recipients])
+
+        await self.bot.edit_message(status, "Sent {}/{} key offers"
+                                    .format(progress["SENT"], len(seen)))
+        if failed:
+            lines = ["{} ({}): {}".format(m.display_name, m.id, r) for m, r in failed]
+            for page in pagify("\n".join(lines)):
+                await self.bot.say(box(page))
+
+    async def on_member_join(self, member):
+        """remembers which invite a member joined through"""
+        server = member.server
+        if server.id not in self.store.server_ids():
+            return
+        before = self.invite_uses.get(server.id)
+        await self._update_invite_uses(server)
+        after = self.invite_uses.get(server.id)
+        if before is None or after is None:
+            return
+        used = [code for code, uses in after.items() if uses > before.get(code, 0)]
+        if len(used) == 1:  # can't tell if two people joined at once
+            self.store.add_invite_join(server.id, used[0], member.id)
+            self._save()
+
+    async def _update_invite_uses(self, server):
+        try:
+            invites = await self.bot.invites_from(server)
+        except discord.HTTPException:  # no manage server permission
+            self.invite_uses.pop(server.id, None)
+            return
+        self.invite_uses[server.id] = {i.code: i.uses for i in invites}
+
+    async def track_invites(self):
+        await self.bot.wait_until_ready()
+        for sid in self.store.server_ids():
+            server = self.bot.get_server(sid)
+            if server is not None:
+                await self._update_invite_uses(server)
+
+    @checks.mod_or_permissions()
+    @commands.group(pass_context=True, no_pm=True)
+    async def keyreport(self, ctx):
+        """Who has gotten which keys"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @keyreport.command(pass_context=True, name="status", no_pm=True)
+    async def keyreport_status(self, ctx, name: KeyFileName=None):
+        """How many keys are available, offered and used"""
+        server = ctx.message.server
+        names = [name] if name else sorted(self.counts)
+        lines = []
+        for name in names:
+            if not self._can_get_key(name, server):
+                continue
+            counts = self.counts.get(name, Counter())
+            lines.append("{}: {} available, {} offered, {} used".format(
+                name, counts[None], counts["IN-PROGRESS"], counts["USED"]))
+        if not lines:
+            return await self.bot.say("No keyfiles are turned on in this server")
+        for page in pagify("\n".join(lines)):
+            await self.bot.say(box(page))
+
+    @keyreport.command(pass_context=True, name="recent", no_pm=True)
+    async def keyreport_recent(self, ctx, name: KeyFileName, count: int=10):
+        """The last keys given out from a keyfile"""
+        if not self._can_get_key(name, ctx.message.server):
+            return await self.bot.say("This server isn't allowed to "
+                                      "generate keys for that keyfile")
+        rows = self.store.recent(name, max(1, min(count, 100)))
+        if not rows:
+            return await self.bot.say("No keys from {} were given out yet".format(name))
+        lines = ["{} {:<11} {} ({}) from {}".format(
+                     time.strftime("%Y-%m-%d %H:%M", time.localtime(date)),
+                     status, rname, ruid, suid)
+                 for key, status, date, rname, ruid, suid in rows]
+        for page in pagify("\n".join(lines)):
+            await self.bot.say(box(page))
+
+    @keyreport.command(pass_context=True, name="senders", no_pm=True)
+    async def keyreport_senders(self, ctx, name: KeyFileName):
+        """How many keys each mod gave out from a keyfile"""
+        server = ctx.message.server
+        if not self._can_get_key(name, server):
+            return await self.bot.say("This server isn't allowed to "
+                                      "generate keys for that keyfile")
+        senders = self.senders.get(name, {})
+        ranked = sorted(senders.items(), key=lambda s: -s[1]["USED"])
+        lines = []
+        for uid, counts in ranked:
+            if not (counts["USED"] or counts["IN-PROGRESS"]):
+                continue
+            member = server.get_member(uid)
+            lines.append("{}: {} accepted, {} waiting".format(
+                member.display_name if member else uid,
+                counts["USED"], counts["IN-PROGRESS"]))
+        if not lines:
+            return await self.bot.say("No keys from {} were given out yet".format(name))
+        for page in pagify("\n".join(lines)):
+            await self.bot.say(box(page))
+
+    @keyreport.command(pass_context=True, name="user", no_pm=True)
+    async def keyreport_user(self, ctx, user: discord.Member):
+        """DMs you the keys a member has gotten"""
+        keys = self.user_keys(user.id)
+        if not keys:
+            return await self.bot.say("{} hasn't gotten any keys".format(user.display_name))
+        await self.bot.send_message(ctx.message.author, "{}'s keys:\n{}".format(
+            user.display_name,
+            box("\n".join("{}: {}".format(name, key)
+                          for name, key in sorted(keys.items())))))
+        await self.bot.say("Sent you {}'s keys".format(user.display_name))
+
+    @keyreport.command(pass_context=True, name="export", no_pm=True)
+    async def keyreport_export(self, ctx, name: KeyFileName):
+        """DMs you every key in a keyfile and who has it, as a csv"""
+        author = ctx.message.author
+        if not self._can_get_key(name, ctx.message.server):
+            return await self.bot.say("This server isn't allowed to "
+                                      "generate keys for that keyfile")
+        await self._flush()  # the export reads what's committed
+        with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as f:
+            path = f.name
+        try:
+            await self.bot.loop.run_in_executor(None, _export_csv, DB_PATH, name, path)
+            await self.bot.send_file(author, path, filename="{}.csv".format(name))
+        finally:
+            os.remove(path)
+        await self.bot.say("Sent you the {} keys".format(name))
+
+    def _await_answer(self, user_id):
+        """starts waiting on a user's yes/no for their open transaction"""
+        answer = self.bot.loop.create_future()
+        self.pending[user_id] = answer
+        self.bot.loop.create_task(self._handle_answer(user_id, answer))
+
+    async def _handle_answer(self, user_id, answer):
         """ await user's response to key offer. If 'yes', send key """
+        try:
+            message = await answer
+        except asyncio.CancelledError:
+            return
+        finally:
+            if self.pending.get(user_id) is answer:
+                del self.pending[user_id]
+
         author = message.author
         author_id = author.id
-        transactions = self.settings["TRANSACTIONS"]
-        if author.id in transactions:
-            data = transactions[author.id]
-            file = data["FILE"]
-            key = data["KEY"]
-            server_id = data["SERVERID"]
-            sender_id = data["SENDERID"]
-            sender = data["SENDER"]
-
-            if message.channel.is_private and message.content.lower().startswith("y"):
-                self._update_key_info(True, file, author.display_name, author.id, sender_id, key)
-                self._del_transact(author_id)
-                await self.bot.send_message(author, self._generate_key_msg(sender, file, key))             
-            
-            elif message.content.lower().startswith("n"):
-                await self.bot.send_message(author, "You chose not to accept the key.")
-                self.settings["FILES"][file]["KEYS"][key] = None
-                self._del_transact(author_id)
-                server = self.bot.get_server(server_id)
-                member = server.get_member(sender_id)
-                await self.bot.send_message(member, "{} ({}) in the {} server has declined the {}"
-                                                    "key you offered him.".format(author.display_name,
-                                                        author_id,server.name,file))
+        data = self.store.transaction(author_id)
+        if data is None:
+            return
+        file = data["FILE"]
+        key = data["KEY"]
+        server_id = data["SERVERID"]
+        sender_id = data["SENDERID"]
+        sender = data["SENDER"]
+
+        if message.content.lower().startswith("y"):
+            self._update_key_info(True, file, author.display_name, author.id, sender_id, key)
+            self._del_transact(author_id)
+            await self._flush()
+            await self.bot.send_message(author, self._generate_key_msg(sender, file, key))             
+        else:
+            await self.bot.send_message(author, "You chose not to accept the key.")
+            self._return_key(file, key, author_id)
+            self._del_transact(author_id)
+            server = self.bot.get_server(server_id)
+            member = server.get_member(sender_id)
+            await self.bot.send_message(member, "{} ({}) in the {} server has declined the {}"
+                                                "key you offered him.".format(author.display_name,
+                                                    author_id,server.name,file))
+
+    async def on_message(self, message):
+        """passes yes/no answers in DMs on to their open transaction"""
+        if not message.channel.is_private:
+            return
+        answer = self.pending.get(message.author.id)
+        if answer is None or answer.done():
+            return
+        if message.content.lower().startswith(("y", "n")):
+            answer.set_result(message)
+
+    def __unload(self):
+        self._watcher.cancel()
+        self._expirer.cancel()
+        for answer in self.pending.values():
+            answer.cancel()
+        if self._saver is not None:
+            self._saver.cancel()
+        self.store.commit()
+        self.store.close()
 
 
 def _name_to_path(name):
@@ -399,6 +1485,79 @@ def _name_to_path(name):
     raise FileNotFoundError('No such file: ' + name)
 
 
+def _keyfile_sig(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _read_keyfile(path, statuses, start=0, check=b"", partial=True):
+    """reads keys from a keyfile starting at byte start and diffs them
+    against statuses ({key: status} already stored). past byte 0 the new
+    lines all come back as added and statuses isn't used
+
+    returns (removed, added, end, check) or None if the bytes just before
+    start aren't check anymore, which means the file was edited rather
+    than appended to. if not partial, reading stops after the last full
+    line so a key that's still being appended isn't taken. end is where
+    the next read should start and check the bytes just before it.
+    meant to run in an executor
+    """
+    with open(path, 'rb') as f:
+        if start:
+            f.seek(start - len(check))
+            if f.read(len(check)) != check:
+                return None
+        data = f.read()
+    if not partial:
+        data = data[:data.rfind(b"\n") + 1]
+    end = start + len(data)
+    check = (check + data)[-KEYFILE_CHECK_BYTES:]
+    keys = list(filter(None, data.decode('utf-8', 'replace').splitlines()))
+    if start:
+        return [], _new_keys(keys, {}), end, check
+    return _diff_keys(keys, statuses) + (end, check)
+
+
+def _diff_keys(keys, statuses):
+    """(removed, added) to go from statuses to the keys in a keyfile.
+    used keys are never removed
+    """
+    file_keys = set(keys)
+    removed = [k for k, status in statuses.items()
+               if k not in file_keys and status != "USED"]
+    return removed, _new_keys(keys, statuses)
+
+
+def _new_keys(keys, statuses):
+    """keys not in statuses yet, in file order so keys still go out top
+    to bottom"""
+    added = []
+    seen = set(statuses)
+    for k in keys:
+        if k not in seen:
+            seen.add(k)
+            added.append(k)
+    return added
+
+
+def _export_csv(db_path, name, path):
+    """writes a keyring to a csv a row at a time. meant to run in an
+    executor, so it uses its own connection"""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT key, status, date, recipient_name, recipient_uid, sender_uid "
+            "FROM keys WHERE keyring = ? ORDER BY rowid", (name,))
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(("key", "status", "date", "recipient",
+                             "recipient_id", "sender_id"))
+            for row in rows:
+                writer.writerow(row)
+    finally:
+        conn.close()
+
+
 def check_folders():
     paths = ("data/keydistrib", KEYS_PATH)
     for path in paths:
@@ -408,22 +1567,39 @@ def check_folders():
 
 
 def check_files():
-    default = {"FILES": {}, "USERS": {}, "TRANSACTIONS": {}}
-
     if not dataIO.is_valid_json(SETTINGS_PATH):
         print("Creating default keydistrib settings.json...")
-        dataIO.save_json(SETTINGS_PATH, default)
+        dataIO.save_json(SETTINGS_PATH, DEFAULT_SETTINGS)
     else:  # consistency check
         current = dataIO.load_json(SETTINGS_PATH)
-        if current.keys() != default.keys():
-            for key in default.keys():
+        if "FILES" in current:
+            migrate_settings(current)
+        if current.keys() != DEFAULT_SETTINGS.keys():
+            for key in DEFAULT_SETTINGS.keys():
                 if key not in current.keys():
-                    current[key] = default[key]
+                    current[key] = DEFAULT_SETTINGS[key]
                     print(
                         "Adding " + str(key) + " field to keydistrib settings.json")
             dataIO.save_json(SETTINGS_PATH, current)
 
 
+def migrate_settings(current):
+    """moves keyrings out of an old settings.json and into the db.
+    the old file is kept as settings.json.bak
+    """
+    print("Migrating keydistrib keyrings from settings.json to {}..."
+          .format(DB_PATH))
+    shutil.copyfile(SETTINGS_PATH, SETTINGS_PATH + ".bak")
+    store = KeyStore(DB_PATH)
+    try:
+        store.migrate(current)
+    finally:
+        store.close()
+    for key in ("FILES", "USERS", "TRANSACTIONS"):
+        current.pop(key, None)
+    dataIO.save_json(SETTINGS_PATH, current)
+
+
 def setup(bot: red.Bot):
     check_folders()
     check_files() 
@@ -0,0 +1,192 @@
+"""stress test for concurrent key offers
+
+fires hundreds of give_keys at once through a fake bot, with and without
+SHARED_DB, and checks no key went out twice. then checks nobody gets a
+second offer (from another keyring, or a bulk give) while one is open.
+then has several stores (standing in for other processes sharing the db)
+claim keys from threads at the same time.
+
+needs the environment the cog loads in (discord.py, Red's cogs package).
+
+    python keydistrib/stress_give_key.py
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import types
+from collections import Counter
+
+
+async def send_cmd_help(ctx):  # cogs import this from red.py's __main__
+    pass
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import keydistrib as kd
+
+KEYS = 150
+GIVES = 300
+USERS = 180  # so some users get offered twice
+PROCESSES = 4
+
+
+def _fake_bot(loop, server, said):
+    async def wait_until_ready():
+        pass
+
+    async def send_message(dest, content=None, **kwargs):
+        await asyncio.sleep(0.001)  # let the other gives in
+
+    async def say(content=None, **kwargs):
+        said.append(content)
+        return content
+
+    async def edit_message(message, content=None, **kwargs):
+        pass
+
+    async def invites_from(server):
+        return []
+
+    return types.SimpleNamespace(
+        loop=loop, wait_until_ready=wait_until_ready,
+        send_message=send_message, say=say, edit_message=edit_message,
+        invites_from=invites_from,
+        get_server=lambda sid: server if sid == server.id else None)
+
+
+def _offered(db_path):
+    """(keys with a status, distinct recipients, open transactions)"""
+    db = sqlite3.connect(db_path)
+    try:
+        keys, recipients = db.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT recipient_uid) FROM keys "
+            "WHERE status IS NOT NULL").fetchone()
+        transactions, = db.execute("SELECT COUNT(*) FROM transactions").fetchone()
+        dupes, = db.execute(
+            "SELECT COUNT(*) FROM (SELECT key FROM transactions "
+            "GROUP BY key HAVING COUNT(*) > 1)").fetchone()
+    finally:
+        db.close()
+    assert dupes == 0, "{} keys are in more than one transaction".format(dupes)
+    return keys, recipients, transactions
+
+
+def _setup(shared_db, keyrings, said):
+    """a cog with keyrings of KEYS keys each, its loop and a ctx from a mod"""
+    kd.check_folders()
+    kd.check_files()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = types.SimpleNamespace(id="s1", name="Server",
+                                   get_member=lambda uid: None)
+    cog = kd.KeyDistrib(_fake_bot(loop, server, said))
+    cog.settings["SHARED_DB"] = shared_db
+    for name in keyrings:
+        with open(os.path.join(kd.KEYS_PATH, name + ".txt"), "w") as f:
+            f.write("".join("{}{}\n".format(name, i) for i in range(KEYS)))
+        cog.new_keyring(server, name)
+    mod = types.SimpleNamespace(id="mod", display_name="Mod")
+    ctx = types.SimpleNamespace(message=types.SimpleNamespace(
+        server=server, channel=None, author=mod))
+    return cog, loop, ctx
+
+
+def _users(n, total):
+    return [types.SimpleNamespace(id="u{}".format(i % n), bot=False,
+                                  display_name="U{}".format(i % n))
+            for i in range(total)]
+
+
+def stress_give_key(shared_db):
+    said = []
+    cog, loop, ctx = _setup(shared_db, ["stress"], said)
+    users = _users(USERS, GIVES)
+    give_key = kd.KeyDistrib.give_key.callback
+
+    loop.run_until_complete(asyncio.gather(
+        *[give_key(cog, ctx, "stress", user) for user in users]))
+    cog._KeyDistrib__unload()
+    loop.run_until_complete(asyncio.sleep(0))  # let cancellations land
+    loop.close()
+
+    keys, recipients, transactions = _offered(kd.DB_PATH)
+    assert keys == recipients == transactions == KEYS, \
+        (keys, recipients, transactions)
+    replies = Counter("already" if "already" in s else
+                      "out" if "No available keys" in s else "offered"
+                      for s in said)
+    assert replies == {"offered": KEYS, "already": GIVES - USERS,
+                       "out": USERS - KEYS}, replies
+    os.remove(kd.DB_PATH)
+
+
+def stress_pending_offers(shared_db):
+    """give_key any twice at once, then a bulk give from the other keyring.
+    nobody may end up with two offers, and every key that left the pool
+    has to belong to an open transaction so it can expire"""
+    said = []
+    cog, loop, ctx = _setup(shared_db, ["a", "b"], said)
+    users = _users(USERS // 2, USERS)
+    give_key = kd.KeyDistrib.give_key.callback
+
+    loop.run_until_complete(asyncio.gather(
+        *[give_key(cog, ctx, None, user) for user in users]))
+    loop.run_until_complete(cog._give_keys(ctx, "b", users[:USERS // 2]))
+    pending = len(cog.pending)
+    cog._KeyDistrib__unload()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+    keys, recipients, transactions = _offered(kd.DB_PATH)
+    assert keys == recipients == transactions == pending == USERS // 2, \
+        (keys, recipients, transactions, pending)
+    waiting = sum("hasn't answered" in s for s in said)
+    assert waiting == USERS // 2, waiting
+    assert "has a pending offer" in said[-1]
+    os.remove(kd.DB_PATH)
+
+
+def stress_claim_key():
+    """other processes on the same db each get their own KeyStore"""
+    kd.check_folders()
+    store = kd.KeyStore(kd.DB_PATH)
+    store.new_keyring("stress", "s1", ["K{}".format(i) for i in range(KEYS)], 0)
+    store.commit()
+    store.close()
+
+    claimed, errors = [], []
+
+    def process(n):
+        store = kd.KeyStore(kd.DB_PATH)
+        for i in range(n, USERS, PROCESSES):
+            t = {"SERVERID": "s1", "SENDERID": "mod", "SENDER": "Mod",
+                 "FILE": "stress", "CREATED": 0}
+            try:
+                claimed.append(store.claim_key("stress", "u{}".format(i),
+                                               "U", t))
+            except IndexError:
+                errors.append(i)
+        store.close()
+
+    threads = [threading.Thread(target=process, args=(n,))
+               for n in range(PROCESSES)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(claimed) == len(set(claimed)) == KEYS, len(claimed)
+    assert len(errors) == USERS - KEYS, len(errors)
+    assert _offered(kd.DB_PATH) == (KEYS, KEYS, KEYS)
+    os.remove(kd.DB_PATH)
+
+
+if __name__ == '__main__':
+    os.chdir(tempfile.mkdtemp())
+    stress_give_key(shared_db=False)
+    stress_give_key(shared_db=True)
+    stress_pending_offers(shared_db=False)
+    stress_pending_offers(shared_db=True)
+    stress_claim_key()
+    print("ok")
@@ -0,0 +1,74 @@
+"""times pico8.cart_label over a folder of stored carts
+
+needs the environment the cog loads in (discord.py, bs4, Red's cogs package)
+plus numpy and Pillow.
+
+    python pico8/bench_cart_label.py [folder] [rounds]
+
+folder defaults to the image cache (data/pico8/images). files that aren't
+carts (thumbnails, avatars) are counted and skipped
+"""
+import os
+import statistics
+import sys
+import time
+
+
+async def send_cmd_help(ctx):  # cogs import this from red.py's __main__
+    pass
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from pico8 import IMAGES_PATH, CartDecodeError, cart_code, cart_label, cart_rom
+
+
+def load_carts(folder):
+    carts, skipped = [], 0
+    for entry in os.scandir(folder):
+        if not entry.is_file():
+            continue
+        with open(entry.path, 'rb') as f:
+            data = f.read()
+        try:
+            cart_label(data)
+        except (CartDecodeError, OSError, ValueError):
+            skipped += 1
+            continue
+        carts.append((entry.name, data))
+    return carts, skipped
+
+
+def bench(carts, rounds):
+    """seconds per cart for each stage, best round of each"""
+    stages = {"rom": [], "code": [], "label": []}
+    for _ in range(rounds):
+        rom_t = code_t = label_t = 0
+        for name, data in carts:
+            start = time.perf_counter()
+            rom = cart_rom(data)
+            mid = time.perf_counter()
+            cart_code(rom)
+            end = time.perf_counter()
+            cart_label(data)
+            label_t += time.perf_counter() - end
+            rom_t += mid - start
+            code_t += end - mid
+        stages["rom"].append(rom_t / len(carts))
+        stages["code"].append(code_t / len(carts))
+        stages["label"].append(label_t / len(carts))
+    return stages
+
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else IMAGES_PATH
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    carts, skipped = load_carts(folder)
+    print("{} carts, {} other files skipped".format(len(carts), skipped))
+    if not carts:
+        return
+    for stage, times in bench(carts, rounds).items():
+        print("{:>6}: best {:.2f} ms  median {:.2f} ms per cart".format(
+            stage, min(times) * 1000, statistics.median(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
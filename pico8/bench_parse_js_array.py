@@ -0,0 +1,93 @@
+"""times pico8.parse_js_array against the old replace-everything path
+
+needs the environment the cog loads in (discord.py, bs4, Red's cogs package).
+
+    python pico8/bench_parse_js_array.py [page.html] [rounds]
+
+page.html is a saved BBS listing page. without one a 32 post page is made
+up in the same shape. both the pdat parse alone and the whole listing
+(finding pdat in the page too) are timed
+"""
+import __main__
+import json
+import os
+import random
+import re
+import sys
+import timeit
+
+if not hasattr(__main__, 'send_cmd_help'):  # cogs import it from red.py
+    async def send_cmd_help(ctx):
+        pass
+    __main__.send_cmd_help = send_cmd_help
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from pico8 import BBS, parse_js_array
+
+NUMBER = 200
+
+RE_POSTS = re.compile(r"var pdat=(.*?);\r\n\t\tvar updat", re.DOTALL)
+CLEANSE = [('\r', ''), ('\n', ''), ('\t', ''), ('`', '"'),
+           (',,', ',null,'), (',]', ']')]
+
+
+def old_parse(js):
+    for p, r in CLEANSE:
+        js = js.replace(p, r)
+    return json.loads(js)
+
+
+def old_listing(raw):
+    return old_parse(re.search(RE_POSTS, raw).group(1))
+
+
+def made_up_page(posts=32, seed=1):
+    rng = random.Random(seed)
+    words = ('pico', 'cart', 'jam', 'space', 'quest', 'demo', 'tiny', 'rogue')
+    rows = []
+    for i in range(posts):
+        pid, aid = 100000 + i, 20000 + rng.randrange(5000)
+        title = ' '.join(rng.choice(words) for _ in range(rng.randrange(1, 5)))
+        tags = ','.join('`{}`'.format(rng.choice(words))
+                        for _ in range(rng.randrange(3)))
+        rows.append(
+            '[ {pid}, {tid}, `{title}`,"/bbs/thumbs/pico8_{pid}.png",96,96,'
+            '"2017-03-18 21:09:44",{aid},"user{aid}","2017-03-19 08:12:01",'
+            '{aid},"user{aid}",{stars},{comments},0,7,{sub},"cart_{pid}",'
+            '[{tags}],0,,]'.format(
+                pid=pid, tid=pid - 50000, title=title, aid=aid, tags=tags,
+                stars=rng.randrange(50), comments=rng.randrange(30),
+                sub=rng.randrange(1, 5)))
+    pdat = '[\r\n\t\t' + ',\r\n\t\t'.join(rows) + ',\r\n\t\t]'
+    filler = '<div class="post">{}</div>\n'.format('x' * 200) * 300
+    return '<html>' + filler + '<script>\r\n\t\tvar pdat=' + pdat + \
+        ';\r\n\t\tvar updat=0;</script>' + filler + '</html>'
+
+
+def best(func, arg, rounds):
+    return min(timeit.repeat(lambda: func(arg), number=NUMBER,
+                             repeat=rounds)) / NUMBER
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding='utf-8') as f:
+            raw = f.read()
+    else:
+        raw = made_up_page()
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    js = re.search(RE_POSTS, raw).group(1)
+    if old_parse(js) != parse_js_array(js):
+        print("the old path parses this page differently")
+    print("{} posts, pdat {} KB of a {} KB page".format(
+        len(parse_js_array(js)), len(js) // 1024, len(raw) // 1024))
+    for name, old, new, arg in (
+            ("pdat", old_parse, parse_js_array, js),
+            ("listing", old_listing, BBS._parse_listing, raw)):
+        old_t, new_t = best(old, arg, rounds), best(new, arg, rounds)
+        print("{:>8}: old {:.1f} us  new {:.1f} us  ({:.2f}x)".format(
+            name, old_t * 1e6, new_t * 1e6, new_t / old_t))
+
+
+if __name__ == '__main__':
+    main()
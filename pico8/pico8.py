@@ -1,6 +1,7 @@
 import discord
 from discord.ext import commands
 from cogs.utils.dataIO import dataIO
+from cogs.utils import checks
 from bs4 import BeautifulSoup
 from bs4 import Comment
 import asyncio
@@ -9,41 +10,907 @@ import aiohttp
 from urllib.request import quote
 import re
 import json
+import hashlib
+import random
+import io
+import sqlite3
+import threading
+import time
 from asyncio import Lock
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from collections.abc import MutableSequence
 from __main__ import send_cmd_help
 from cogs import repl
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = Image = None
 
 
 SETTINGS_PATH = "data/pico8/settings.json"
 PICKS_PATH =    "data/pico8/picks.json"
 ERROR_PATH =    "data/pico8/error.log"
+INDEX_PATH =    "data/pico8/index.sqlite"
+IMAGES_PATH =   "data/pico8/images"
+IMAGES_INDEX_PATH = "data/pico8/images.json"
+STATS_PATH =    "data/pico8/stats.json"
 NBS = '​'
 
+# .p8.png carts
+CART_ROM_SIZE = 0x8000
+CART_CODE = 0x4300
+CART_CODE_CHARS = "\n 0123456789abcdefghijklmnopqrstuvwxyz!#%(){}[]<>+=/*:;.,~_"
+
+DEFAULT_SETTINGS = {
+    "INDEX": {
+        "ENABLED": False,
+        "INTERVAL": 60 * 60,  # seconds between crawls
+        "PAGES": 5,           # max listing pages per category per crawl
+        "DELAY": 2,           # seconds between page fetches. be nice
+        "CATEGORIES": [["PICO8", "CARTRIDGES"], ["PICO8", "WIP"],
+                       ["PICO8", "JAMS"], ["PICO8", "SNIPPETS"]]
+    },
+    "IMAGES": {
+        "ENABLED": False,
+        "MAX_MB": 50,            # local image cache size
+        "MIRROR_CHANNEL": None   # channel id to upload images to for embeds
+    },
+    "NOTIFY": {
+        "INTERVAL": 5 * 60,  # seconds between polls of each feed
+        "CHANNELS": {},      # channel id: ["CAT:SUB" feeds]
+        "SEEN": {}           # "CAT:SUB": [latest pids]
+    }
+}
+SEEN_LIMIT = 100  # pids remembered per feed. a listing page is 32
+
+
+class LazyTasks(MutableSequence):
+    """Makes its items only when they are accessed
+    and calls a callback with the index first
 
-class ReactiveList(MutableSequence):
-    """calls a callback with the list item when it is accessed
+    length can grow as more results come in. items assigned or inserted
+    are stored and handed back as they are instead of made
     """
 
-    def __init__(self, *args, callback, **kwargs):
+    def __init__(self, *, callback, factory, length=0):
         self.callback = callback
-        self._list = list(args[0]) if len(args) else []
+        self.factory = factory
+        self._slots = []  # factory index, or (stored item,)
+        self._made = 0
+        self.length = length
+
+    @property
+    def length(self):
+        return self._made
+
+    @length.setter
+    def length(self, n):
+        self._slots.extend(range(self._made, n))
+        self._made = max(self._made, n)
 
     def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('LazyTasks index out of range')
         self.callback(key)
-        return self._list[key]
+        slot = self._slots[key]
+        return slot[0] if isinstance(slot, tuple) else self.factory(slot)
 
     def __setitem__(self, key, value):
-        self._list[key] = value
+        if isinstance(key, slice):
+            self._slots[key] = [(v,) for v in value]
+        else:
+            self._slots[key] = (value,)
 
     def __delitem__(self, key):
-        del self._list[key]
+        del self._slots[key]
 
     def __len__(self):
-        return len(self._list)
+        return len(self._slots)
 
     def insert(self, key, value):
-        return self._list.insert(key, value)
+        self._slots.insert(key, (value,))
+
+
+class CartIndex:
+    """Local full-text index of BBS listings
+
+    Rows are stored as the raw pdat arrays from the listing pages
+    so BBS can build posts from them the same way it does for live results.
+
+    sqlite is blocking, so call these through loop.run_in_executor
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS carts (
+            pid     INTEGER PRIMARY KEY,
+            tid     INTEGER,
+            cat     INTEGER,
+            sub     INTEGER,
+            stars   INTEGER,
+            date    TEXT,
+            row     TEXT NOT NULL,
+            desc    TEXT,
+            cc      INTEGER,
+            updated REAL
+        );
+        CREATE INDEX IF NOT EXISTS carts_cat_sub_date ON carts (cat, sub, date);
+        CREATE VIRTUAL TABLE IF NOT EXISTS carts_fts
+            USING fts5(title, author, tags, desc);
+    """
+    # column weights: title, author, tags, desc
+    RELEVANCE = "bm25(carts_fts, 10.0, 5.0, 5.0, 1.0)"
+    ORDER = {
+        "RECENT":     "c.date DESC, c.pid DESC",
+        "FEATURED":   "c.stars DESC, c.date DESC",
+        "RATING":     "c.stars DESC, c.date DESC",
+        "FAVORITES":  "c.stars DESC, c.date DESC",
+        "FAVOURITES": "c.stars DESC, c.date DESC",
+        "RELEVANCE":  RELEVANCE + ", c.stars DESC"
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(CartIndex.SCHEMA)
+        columns = [c[1] for c in self.conn.execute("PRAGMA table_info(carts)")]
+        if 'cc' not in columns:  # indexes from before cc was stored
+            self.conn.execute("ALTER TABLE carts ADD COLUMN cc INTEGER")
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM carts").fetchone()[0]
+
+    def add_rows(self, rows):
+        """inserts/updates listing rows. returns how many weren't indexed yet"""
+        new = 0
+        now = time.time()
+        with self._lock, self.conn:
+            for p in rows:
+                pid = p[0]
+                old = self.conn.execute("SELECT desc, cc FROM carts "
+                                        "WHERE pid = ?", (pid,)).fetchone()
+                desc, cc = old if old else (None, None)
+                new += old is None
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO carts "
+                    "(pid, tid, cat, sub, stars, date, row, desc, cc, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (pid, p[1], p[15], p[16], p[12], p[6], json.dumps(p),
+                     desc, cc, now))
+                self.conn.execute("DELETE FROM carts_fts WHERE rowid = ?", (pid,))
+                self.conn.execute(
+                    "INSERT INTO carts_fts (rowid, title, author, tags, desc) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (pid, p[2], p[8], ' '.join(p[18] or []), desc or ''))
+        return new
+
+    def set_desc(self, pid, desc, cc):
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE carts SET desc = ?, cc = ? WHERE pid = ?",
+                              (desc, cc, pid))
+            self.conn.execute("UPDATE carts_fts SET desc = ? WHERE rowid = ?",
+                              (desc, pid))
+
+    def search(self, term, cat=None, sub=None, orderby="RECENT", limit=32,
+               offset=0):
+        """returns [(row, desc, cc)] best matches first"""
+        sql = "SELECT c.row, c.desc, c.cc FROM carts c"
+        where, args = [], []
+        query = _fts_query(term)
+        if query:
+            sql += " JOIN carts_fts ON carts_fts.rowid = c.pid"
+            where.append("carts_fts MATCH ?")
+            args.append(query)
+        elif orderby == "RELEVANCE":
+            orderby = "RECENT"
+        if cat is not None:
+            where.append("c.cat = ?")
+            args.append(int(cat))
+        if sub is not None:
+            where.append("c.sub = ?")
+            args.append(int(sub))
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY {} LIMIT ? OFFSET ?".format(
+            CartIndex.ORDER.get(orderby, CartIndex.ORDER["RECENT"]))
+        args.extend((limit, offset))
+        with self._lock:
+            try:
+                found = self.conn.execute(sql, args).fetchall()
+            except sqlite3.OperationalError:  # bad fts query
+                return []
+        return [(json.loads(row), desc, None if cc is None else bool(cc))
+                for row, desc, cc in found]
+
+
+# js -> json for the pdat array. elisions and trailing commas.
+# the plain replaces the page always got are used whenever they can't
+# reach into a string, which is nearly always
+_JS_FIXUPS = (('`', '"'), (',,', ',null,'), (',]', ']'))
+_RE_JS_LEADING_HOLE = re.compile(r'\[\s*,')  # [, and [ ,] which ,] would empty
+_RE_JS_TOKEN = re.compile(r'`((?:[^`\\]|\\.)*)`'      # `template string`
+                          r'|("(?:[^"\\]|\\.)*")'     # "string"
+                          r'|([\[,])(?=\s*,)'         # elided element
+                          r'|,(?=\s*\])', re.DOTALL)  # trailing comma
+_RE_TEMPLATE_ESCAPE = re.compile(r'\\(.)|"', re.DOTALL)
+_JSON_ESCAPES = frozenset('"\\/bfnrtu')
+_JSON = json.JSONDecoder(strict=False)  # raw line breaks in titles
+
+
+def _fixups_are_safe(js):
+    """whether _JS_FIXUPS keep the page's meaning
+
+    without backslashes, splitting on each kind of quote finds the strings
+    of that kind as long as neither kind holds the other. the fixups are
+    then safe if no string holds a comma run and no array starts with a hole
+    """
+    if '\\' in js:
+        return False
+    templates = js.split('`')
+    strings = js.split('"')
+    if not len(templates) % 2 or not len(strings) % 2:  # unterminated
+        return False
+    templates = '\0'.join(templates[1::2])
+    strings = '\0'.join(strings[1::2])
+    if '"' in templates or '`' in strings:
+        return False
+    if ',' in templates or ',' in strings:
+        inside = templates + '\0' + strings
+        if ',,' in inside or ',]' in inside:
+            return False
+    return not _RE_JS_LEADING_HOLE.search(js)
+
+
+def _template_escape_to_json(m):
+    c = m.group(1)
+    if c is None:  # bare " inside the template
+        return '\\"'
+    if c in _JSON_ESCAPES:
+        return m.group(0)
+    return '' if c == '\n' else c  # \` \$ \' etc. and line continuations
+
+
+def _js_token_to_json(m):
+    template, string, sep = m.groups()
+    if template is not None:
+        if '\\' in template or '"' in template:
+            template = _RE_TEMPLATE_ESCAPE.sub(_template_escape_to_json,
+                                               template)
+        return '"' + template + '"'
+    if string is not None:
+        return string
+    if sep is not None:
+        return sep + 'null'
+    return ''
+
+
+def parse_js_array(js):
+    """parses the js array literal the BBS puts its listings in
+
+    When no string on the page could be touched by them, the backticks are
+    swapped for quotes, elisions filled with null and trailing commas
+    dropped with plain replaces. Otherwise (or if that still isn't valid
+    json, e.g. holes split by whitespace) it retokenizes the page in one
+    pass so the elision fixes never touch what's inside a string.
+
+    raises json.decoder.JSONDecodeError if it still isn't valid
+    """
+    if _fixups_are_safe(js):
+        fixed = js.rstrip()
+        if fixed.endswith(']'):  # the last , may be on a line of its own
+            fixed = fixed[:-1].rstrip() + ']'
+        for old, new in _JS_FIXUPS:
+            fixed = fixed.replace(old, new)
+        try:
+            return _JSON.decode(fixed)
+        except json.decoder.JSONDecodeError:
+            pass
+    return _JSON.decode(_RE_JS_TOKEN.sub(_js_token_to_json, js))
+
+
+_picks = {"MTIME": None, "PICKS": ()}
+
+
+def load_picks():
+    """((msg, embed), ...) for the picks.json easter egg
+
+    built once and shared by every search.
+    only rebuilt when the file changes
+    """
+    # TODO: later, load them from the site in case of updates?
+    mtime = os.path.getmtime(PICKS_PATH)
+    if mtime != _picks["MTIME"]:
+        _picks["PICKS"] = tuple((msg, BBS._post_to_embed(Post.from_dict(p)))
+                                for msg, p in dataIO.load_json(PICKS_PATH))
+        _picks["MTIME"] = mtime
+    return _picks["PICKS"]
+
+
+class ImageFetchError(Exception):
+    pass
+
+
+class BBSDown(Exception):
+    pass
+
+
+class CircuitOpen(BBSDown):
+    pass
+
+
+class CircuitBreaker:
+    """Stops hitting a host that keeps failing
+
+    After THRESHOLD failures in a row, requests fail fast with CircuitOpen
+    for a cooldown that doubles every time the host is still down.
+    After each cooldown a single request is let through to check on it.
+
+    Also keeps the numbers on retries and downtime
+    """
+    THRESHOLD = 5
+    COOLDOWN = 30
+    MAX_COOLDOWN = 10 * 60
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.cooldown = CircuitBreaker.COOLDOWN
+        self.opened_at = None  # None while closed
+        self.retry_at = 0
+        self.trial = False
+        # metrics
+        self.trips = 0
+        self.short_circuits = 0
+        self.retries = 0
+        self.closed_open_time = 0.0
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    @property
+    def open_time(self):
+        """seconds spent open, including right now"""
+        current = time.monotonic() - self.opened_at if self.is_open else 0
+        return self.closed_open_time + current
+
+    def check(self):
+        """raises CircuitOpen if requests shouldn't go through right now
+
+        returns True if this request is the trial. it has to end in
+        success() or failure() or the circuit stays open
+        """
+        if not self.is_open:
+            return False
+        if self.trial or time.monotonic() < self.retry_at:
+            self.short_circuits += 1
+            raise CircuitOpen("{} seems to be down. Trying again in {:.0f}s"
+                              .format(self.name,
+                                      max(0, self.retry_at - time.monotonic())))
+        self.trial = True  # let this one through
+        return True
+
+    def success(self):
+        if self.is_open:
+            self.closed_open_time += time.monotonic() - self.opened_at
+            self.opened_at = None
+        self.failures = 0
+        self.trial = False
+        self.cooldown = CircuitBreaker.COOLDOWN
+
+    def failure(self):
+        self.failures += 1
+        now = time.monotonic()
+        if self.trial:  # still down
+            self.trial = False
+            self.cooldown = min(self.cooldown * 2, CircuitBreaker.MAX_COOLDOWN)
+            self.retry_at = now + self.cooldown
+        elif not self.is_open and self.failures >= CircuitBreaker.THRESHOLD:
+            self.trips += 1
+            self.opened_at = now
+            self.retry_at = now + self.cooldown
+            print("Pico8: {} failed {} times in a row. Backing off for {}s"
+                  .format(self.name, self.failures, self.cooldown))
+
+
+BBS_CIRCUIT = CircuitBreaker("lexaloffle.com")
+
+
+class Timings:
+    """Latency of each stage of a bbs search, plus some cache counters
+
+    keeps the last SAMPLES timings per stage for the percentiles
+    """
+    SAMPLES = 1000
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        st = self.stages.get(stage)
+        if st is None:
+            st = self.stages[stage] = {
+                "COUNT": 0, "TOTAL": 0.0,
+                "SAMPLES": deque(maxlen=Timings.SAMPLES)}
+        st["COUNT"] += 1
+        st["TOTAL"] += seconds
+        st["SAMPLES"].append(seconds)
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def summary(self):
+        """{stage: {COUNT, MEAN, P50, P95, P99, MAX}} in ms, and counters"""
+        stages = OrderedDict()
+        for stage, st in self.stages.items():
+            samples = sorted(st["SAMPLES"])
+            n = len(samples)
+
+            def pct(p):
+                return samples[min(n - 1, int(p / 100 * n))] * 1000
+
+            stages[stage] = OrderedDict((
+                ("COUNT", st["COUNT"]),
+                ("MEAN", st["TOTAL"] / st["COUNT"] * 1000),
+                ("P50", pct(50)), ("P95", pct(95)), ("P99", pct(99)),
+                ("MAX", samples[-1] * 1000)))
+        return {"SINCE": self.since, "STAGES": stages,
+                "COUNTERS": dict(self.counters)}
+
+
+STATS = Timings()
+
+
+async def _request(url, params=None, headers=None, binary=False):
+    """GET through the BBS circuit breaker. returns (response, body)
+
+    raises BBSDown on server errors or while the circuit is open
+    """
+    trial = BBS_CIRCUIT.check()
+    try:
+        async with aiohttp.get(url, params=params, headers=headers) as r:
+            body = await (r.read() if binary else r.text())
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        BBS_CIRCUIT.failure()
+        raise
+    except BaseException:
+        # cancelled (or broke) mid-trial. it still has to end the trial
+        if trial:
+            BBS_CIRCUIT.failure()
+        raise
+    if r.status >= 500:
+        BBS_CIRCUIT.failure()
+        raise BBSDown("{} returned {}".format(url, r.status))
+    BBS_CIRCUIT.success()
+    return r, body
+
+
+class ImageCache:
+    """Content-addressed, size-bounded cache of BBS images
+
+    Images are stored under the sha1 of their bytes, so one image behind
+    a few urls is only stored once. Least recently used ones go first
+    when the cache is full.
+
+    With a mirror channel set, each image is uploaded there once
+    and embeds point at that copy instead of at the BBS.
+
+    Also remembers author avatars so they don't need a thread to find.
+    """
+    SAVE_EVERY = 20  # changes before the index is written out
+
+    def __init__(self, bot, settings, path=IMAGES_PATH,
+                 index_path=IMAGES_INDEX_PATH):
+        self.bot = bot
+        self.settings = settings
+        self.path = path
+        self.index_path = index_path
+        if dataIO.is_valid_json(index_path):
+            data = dataIO.load_json(index_path)
+        else:
+            data = {}
+        self.author_pics = data.get("AUTHORS", {})  # aid: avatar url
+        self._unsaved = 0
+        files = sorted(os.scandir(path), key=lambda e: e.stat().st_mtime)
+        self.files = OrderedDict((e.name, e.stat().st_size) for e in files)
+        self.total = sum(self.files.values())
+        self.urls = {}    # url: {"HASH", "MIRROR"}
+        self.hashes = {}  # hash: {urls}. so evicting a file drops its urls
+        for url, entry in data.get("URLS", {}).items():
+            if entry["HASH"] in self.files:
+                self._add_url(url, entry)
+
+    @property
+    def max_bytes(self):
+        return self.settings["MAX_MB"] * 1024 * 1024
+
+    def save(self):
+        dataIO.save_json(self.index_path, {"URLS": self.urls,
+                                           "AUTHORS": self.author_pics})
+        self._unsaved = 0
+
+    def get_author_pic(self, aid):
+        return self.author_pics.get(str(aid))
+
+    def _changed(self):
+        self._unsaved += 1
+        if self._unsaved >= ImageCache.SAVE_EVERY:
+            self.save()
+
+    def _add_url(self, url, entry):
+        old = self.urls.get(url)
+        if old is not None:  # the image behind the url changed
+            self.hashes[old["HASH"]].discard(url)
+        self.urls[url] = entry
+        self.hashes.setdefault(entry["HASH"], set()).add(url)
+
+    def set_author_pic(self, aid, url):
+        if self.author_pics.get(str(aid)) == url:
+            return
+        self.author_pics[str(aid)] = url
+        self._changed()
+
+    async def fetch(self, url):
+        """the image's bytes, downloading it only if it isn't cached"""
+        loop = self.bot.loop
+        entry = self.urls.get(url)
+        name = entry and entry["HASH"]
+        if name in self.files:
+            STATS.count("image cache hits")
+            self.files.move_to_end(name)
+            return await loop.run_in_executor(None, self._read, name)
+
+        STATS.count("image cache misses")
+        with STATS.span("image fetch"):
+            r, data = await _request(url, binary=True)
+        if r.status != 200:
+            raise ImageFetchError("{} returned {}".format(url, r.status))
+        name = hashlib.sha1(data).hexdigest()
+        if name not in self.files:
+            await loop.run_in_executor(None, self._write, name, data)
+            self.files[name] = len(data)
+            self.total += len(data)
+        else:
+            self.files.move_to_end(name)
+        self._add_url(url, {"HASH": name, "MIRROR": None})
+        self._evict()
+        self._changed()
+        return data
+
+    async def mirror(self, url):
+        """url of the image's copy in the mirror channel. None if unset"""
+        entry = self.urls.get(url)
+        if entry and entry["MIRROR"]:
+            return entry["MIRROR"]
+        channel = self.bot.get_channel(self.settings["MIRROR_CHANNEL"])
+        if channel is None:
+            return None
+        data = await self.fetch(url)
+        filename = os.path.basename(url.split('?')[0]) or 'image.png'
+        msg = await self.bot.send_file(channel, io.BytesIO(data),
+                                       filename=filename)
+        mirrored = msg.attachments[0]['url']
+        entry = self.urls.get(url)
+        if entry is not None:  # could have been evicted already
+            entry["MIRROR"] = mirrored
+            self._changed()
+        return mirrored
+
+    async def localize(self, post):
+        """points the post's cart images at their mirrored copies"""
+        for attr in ('thumb', 'png'):
+            url = getattr(post, attr)
+            if url is None:
+                continue
+            try:
+                mirrored = await self.mirror(url)
+            except (ImageFetchError, BBSDown, aiohttp.ClientError,
+                    asyncio.TimeoutError, discord.HTTPException, OSError):
+                continue
+            if mirrored:
+                setattr(post, attr, mirrored)
+
+    def _read(self, name):
+        path = os.path.join(self.path, name)
+        os.utime(path)  # keeps the lru order across restarts
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _write(self, name, data):
+        with open(os.path.join(self.path, name), 'wb') as f:
+            f.write(data)
+
+    def _evict(self):
+        while self.total > self.max_bytes and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            self.total -= size
+            for url in self.hashes.pop(name, ()):
+                del self.urls[url]
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+
+class CartDecodeError(Exception):
+    pass
+
+
+def cart_rom(png):
+    """the 32k rom a .p8.png hides in the low 2 bits of each pixel
+
+    needs numpy and Pillow
+    """
+    pixels = np.asarray(Image.open(io.BytesIO(png)).convert('RGBA'),
+                        dtype=np.uint8).reshape(-1, 4)
+    if len(pixels) < CART_ROM_SIZE:
+        raise CartDecodeError("Image is too small to be a cart")
+    low = pixels[:CART_ROM_SIZE] & 3
+    # each byte is ARGB, 2 bits each
+    rom = (low[:, 3] << 6) | (low[:, 0] << 4) | (low[:, 1] << 2) | low[:, 2]
+    return rom.tobytes()
+
+
+def cart_code(rom):
+    """the lua code of a cart rom, decompressed"""
+    code = rom[CART_CODE:CART_ROM_SIZE]
+    if code[:4] == b':c:\x00':
+        out = _decompress_old(code)
+    elif code[:4] == b'\x00pxa':
+        out = _decompress_pxa(code)
+    else:  # plain text
+        out = code.split(b'\x00', 1)[0]
+    return out.decode('latin-1')
+
+
+def _decompress_old(code):
+    length = int.from_bytes(code[4:6], 'big')
+    out = bytearray()
+    pos = 8
+    try:
+        while len(out) < length:
+            b = code[pos]
+            if b == 0x00:  # literal
+                out.append(code[pos + 1])
+                pos += 2
+            elif b < 0x3c:  # common character
+                out.append(ord(CART_CODE_CHARS[b - 1]))
+                pos += 1
+            else:  # copy from earlier
+                n = code[pos + 1]
+                offset = (b - 0x3c) * 16 + (n & 0xf)
+                start = len(out) - offset
+                if start < 0:
+                    raise CartDecodeError("Bad back reference")
+                for i in range((n >> 4) + 2):
+                    out.append(out[start + i])
+                pos += 2
+    except IndexError:
+        raise CartDecodeError("Compressed code ended early") from None
+    return bytes(out)
+
+
+def _decompress_pxa(code):
+    length = int.from_bytes(code[4:6], 'big')
+    bits = np.unpackbits(np.frombuffer(code[8:], dtype=np.uint8),
+                         bitorder='little').tolist()
+    pos = 0
+
+    def read(n):
+        nonlocal pos
+        value = 0
+        for i, bit in enumerate(bits[pos:pos + n]):
+            value |= bit << i
+        pos += n
+        return value
+
+    mtf = list(range(256))
+    out = bytearray()
+    try:
+        while len(out) < length:
+            if bits[pos]:  # move-to-front literal
+                pos += 1
+                extra = 0
+                while bits[pos]:
+                    extra += 1
+                    pos += 1
+                pos += 1
+                index = read(4 + extra) + (((1 << extra) - 1) << 4)
+                c = mtf.pop(index)
+                mtf.insert(0, c)
+                out.append(c)
+                continue
+            pos += 1
+            if bits[pos]:
+                offset_bits = 10 if bits[pos + 1] == 0 else 5
+                pos += 2
+            else:
+                offset_bits = 15
+                pos += 1
+            offset = read(offset_bits) + 1
+            if offset_bits == 10 and offset == 1:  # raw block
+                c = read(8)
+                while c:
+                    out.append(c)
+                    c = read(8)
+                continue
+            count = 3
+            part = 7
+            while part == 7:
+                part = read(3)
+                count += part
+            start = len(out) - offset
+            if start < 0:
+                raise CartDecodeError("Bad back reference")
+            for i in range(count):
+                out.append(out[start + i])
+    except IndexError:
+        raise CartDecodeError("Compressed code ended early") from None
+    return bytes(out)
+
+
+def cart_label(png):
+    """(title, author) from the header comments of a cart's code
+
+    either is None if the cart doesn't have it
+    """
+    lines = cart_code(cart_rom(png)).split('\n', 2)
+    header = [l[2:].strip() for l in lines[:2] if l.startswith('--')]
+    title = header[0] if header else None
+    author = header[1] if len(header) > 1 else None
+    if author and author.lower().startswith('by '):
+        author = author[3:].strip()
+    return title or None, author or None
+
+
+def _fts_query(term):
+    """quotes each search word as an fts5 prefix query"""
+    words = term.split()
+    return ' '.join('"{}"*'.format(w.replace('"', '""')) for w in words)
+
+
+class Post:
+    """A post from a BBS listing
+
+    A search holds on to a lot of these, so it's slotted,
+    works out its urls when asked for them instead of storing them,
+    and only makes its lock when something actually waits on it
+    """
+    __slots__ = ('pid', 'tid', 'title', 'desc', 'date', 'aid', 'author',
+                 'stars', 'cc', 'comments', 'cat', 'sub', 'cid', 'tags',
+                 'cart_title', 'cart_author', 'status', 'embed',
+                 'failures', 'retry_at', '_thumb', '_png', '_author_pic',
+                 '_lock')
+    DEFAULT_AUTHOR_PIC = "https://www.lexaloffle.com/bimg/pi/pi28.png"
+
+    # [38386, 28997, `Poop Blaster`,"thumbs/pico38385.png",
+    #  0:pid 1:tid 2:title 3:thumb
+    # 64,64,"2017-03-18",15018,"chase","2017-03-19",9551,
+    # 4:w 5:h 6:date 7:aid 8:author 9:date2 10:uid
+    # "kittenm4ster",0,2,0,
+    # 11:last 12:likes 13:comments 14:?
+    # 7,3,38385,[],0]
+    # 15:cat 16:subcat 17:cid 18:tags 19:resolved
+    def __init__(self, p, desc=None, cc=None):
+        self.pid = p[0]
+        self.tid = p[1]
+        self.title = p[2]
+        self._thumb = p[3]
+        self.date = p[6]
+        self.aid = p[7]
+        self.author = p[8]
+        self.stars = p[12]
+        self.comments = p[13]
+        # p[14] used in generate_cart_preview.
+        # apparently is also the cart id sometimes?
+        self.cat = p[15]
+        self.sub = p[16]
+        self.cid = p[17]
+        self.tags = p[18]
+        self.desc = desc  # temp until loaded
+        self.cc = cc      # None until known. kept through unloads like desc
+        self.unload()
+        self.status = ""
+        self.failures = 0
+        self.retry_at = 0
+        self._lock = None
+
+    @classmethod
+    def from_dict(cls, d):
+        """builds a post from the old dict format (picks.json)"""
+        post = cls([d['PID'], d['TID'], d['TITLE'], d['THUMB'], None, None,
+                    d['DATE'], d['AID'], d['AUTHOR'], None, None, None,
+                    d['STARS'], d['COMMENTS'], None, d['CAT'], d['SUB'],
+                    d['CID'], d['TAGS']], d['DESC'])
+        post.author_pic = d['AUTHOR_PIC']
+        post.png = d['PNG']
+        post.cc = d['CC']
+        post.cart_title = d['CART_TITLE']
+        post.cart_author = d['CART_AUTHOR']
+        return post
+
+    def unload(self):
+        """drops everything _load_post filled in"""
+        self._png = None
+        self._author_pic = None
+        self.cart_title = None
+        self.cart_author = None
+        self.embed = None
+
+    @property
+    def lock(self):
+        if self._lock is None:
+            self._lock = Lock()
+        return self._lock
+
+    @property
+    def url(self):
+        return "{}?tid={}".format(BBS.BASE, self.tid)
+
+    @property
+    def param(self):
+        return {"tid": self.tid}
+
+    @property
+    def author_url(self):
+        return "{}?uid={}".format(BBS.BASE, self.aid)
+
+    @property
+    def author_pic(self):
+        return self._author_pic or Post.DEFAULT_AUTHOR_PIC
+
+    @author_pic.setter
+    def author_pic(self, url):
+        self._author_pic = url
+
+    @property
+    def thumb(self):
+        path = self._thumb
+        if path.startswith('http'):
+            return path
+        return BBS.BASE + quote('..' + path if path[0] == '/' else path)
+
+    @thumb.setter
+    def thumb(self, url):
+        self._thumb = url
+
+    @property
+    def png(self):
+        if self._png is not None:
+            return self._png
+        if self.cat not in (6, 7) or self.cid is None:
+            return None
+        return BBS.BASE + ('cposts/{}/{}.p8.png' if self.cat == 7 else
+                           'cposts/{}/cpost{}.png').format(self.cid // 10000,
+                                                           self.cid)
+
+    @png.setter
+    def png(self, url):
+        self._png = url
 
 
 class BBS:
@@ -73,16 +940,27 @@ class BBS:
             "FEATURED":      "rating",
             "RATING":        "rating",
             "FAVORITES":     "favourites",  # shouldn't be used by bot (yet?)
-            "FAVOURITES":    "favourites"
+            "FAVOURITES":    "favourites",
+            "RELEVANCE":     "ts"  # local index only. site falls back to recent
         }
     }
-    RE_POSTS = re.compile(r"var pdat=(.*?);\r\n\t\tvar updat", re.DOTALL)
+    POSTS_START = "var pdat="
+    POSTS_END = ";\r\n\t\tvar updat"
     RE_CART_BG = re.compile("background:url\('(.*?)'\)", re.DOTALL)
-
-    def __init__(self, loop, search, orderby="RECENT", params={}):
+    KEEP_LOADED = 4  # loaded posts further than this from the current one get unloaded
+    PAGE_SIZE = 32   # posts per listing page
+    PREFETCH = 8     # start getting the next page this many posts from the end
+    MAX_PAGES = 3    # pages of posts kept in memory at once
+    RETRY_BASE = 1   # seconds. backoff for a post that failed to load
+    RETRY_CAP = 60
+
+    def __init__(self, loop, search, orderby="RECENT", params={}, index=None,
+                 images=None):
         self.url = BBS.BASE
         self.search_term = search
         self.loop = loop
+        self.index = index
+        self.images = images
         self.orderby = params.get('orderby', orderby)
         self.params = {}
         for p, v in params.items():
@@ -90,16 +968,107 @@ class BBS:
         self.posts = []
         self.current_post = 0
         self.queue = []
-        self.embeds = []
-        self.load_tasks = ReactiveList(callback=self.queue_area)
-        self.locks = []
-        self.picks = dataIO.load_json(PICKS_PATH)
-        # TODO: later, load them from the site in case of updates?
+        self.loaded = set()
+        self.load_tasks = LazyTasks(callback=self.queue_area,
+                                    factory=self._gen_embed)
+        self.from_index = False
+        self.last_page = 0
+        self.more = False
+        self.page_tasks = {}
+        self.resident = OrderedDict()  # pages with posts in memory
 
     def queue_area(self, i):
         self.posts[i]
-        self.queue.extend([i, (i + 1) % len(self.posts),
-                              (i - 1) % len(self.posts)])
+        self.current_post = i
+        n = len(self.posts)
+        self.queue.extend([i, (i + 1) % n, (i - 1) % n])
+        self._unload_far_posts()
+        if self.posts[i] is None:  # dropped page came back into view
+            self._ensure_page(self._page_of(i))
+        if self.more and i >= n - BBS.PREFETCH:
+            self._ensure_page(self.last_page + 1)
+
+    def _page_of(self, i):
+        return i // BBS.PAGE_SIZE + 1
+
+    def _ensure_page(self, page):
+        """fetches a page in the background unless it's already on its way"""
+        task = self.page_tasks.get(page)
+        if task is None or task.cancelled() or \
+           (task.done() and task.exception() is not None):
+            task = self.loop.create_task(self._fetch_page(page))
+            self.page_tasks[page] = task
+        return task
+
+    async def _fetch_page(self, page):
+        if self.from_index:
+            found = await self.loop.run_in_executor(
+                None, self.index.search, self.params.get('search', ''),
+                self.params.get('cat'), self.params.get('sub'), self.orderby,
+                BBS.PAGE_SIZE, (page - 1) * BBS.PAGE_SIZE)
+        else:
+            params = dict(self.params, page=page)
+            with STATS.span("listing fetch"):
+                raw = await self._get(params)
+            rows = self._parse_listing(raw)
+            if rows and self.index is not None:
+                self.loop.run_in_executor(None, self.index.add_rows, rows)
+            found = [(p, None, None) for p in rows]
+        self._add_page(page, found)
+
+    def _add_page(self, page, found):
+        start = (page - 1) * BBS.PAGE_SIZE
+        end = start + len(found)
+        if end > len(self.posts):
+            self.posts.extend([None] * (end - len(self.posts)))
+            self.load_tasks.length = len(self.posts)
+        posts = [Post(p, desc, cc) for p, desc, cc in found]
+        if self.images is not None:
+            for post in posts:
+                post.author_pic = self.images.get_author_pic(post.aid)
+        self.posts[start:end] = posts
+        if page > self.last_page:
+            self.last_page = page
+            self.more = len(found) >= BBS.PAGE_SIZE
+        self.resident[page] = True
+        self.resident.move_to_end(page)
+        self._drop_far_pages()
+
+    def _drop_far_pages(self):
+        """keeps at most MAX_PAGES pages of posts around.
+        dropped ones are fetched again if they're scrolled back to"""
+        current = self._page_of(self.current_post)
+        while len(self.resident) > BBS.MAX_PAGES:
+            far = max(self.resident, key=lambda p: abs(p - current))
+            del self.resident[far]
+            self.page_tasks.pop(far, None)
+            start = (far - 1) * BBS.PAGE_SIZE
+            for i in range(start, min(start + BBS.PAGE_SIZE, len(self.posts))):
+                self.posts[i] = None
+                self.loaded.discard(i)
+
+    async def _gen_embed(self, i):
+        if self.posts[i] is None:
+            await self._ensure_page(self._page_of(i))
+        if self.posts[i] is None:  # the listing shifted under us
+            return "Looks like that post moved. Try searching again"
+        await self._populate_post(i)
+        return self.posts[i].embed
+
+    def _unload_far_posts(self):
+        """frees loaded posts that are far from the current one.
+        they'll just be loaded again if they come back into view"""
+        n = len(self.posts)
+        for i in list(self.loaded):
+            distance = abs(i - self.current_post)
+            if min(distance, n - distance) <= BBS.KEEP_LOADED:
+                continue
+            post = self.posts[i]
+            if post is None or post.status != 'success':
+                continue
+            post.unload()
+            post.status = ''
+            self.loaded.discard(i)
 
     async def __aenter__(self):
         self.runner = self.loop.create_task(self._queue_runner())
@@ -108,6 +1077,8 @@ class BBS:
 
     async def __aexit__(self, *args):
         self.runner.cancel()
+        for task in self.page_tasks.values():
+            task.cancel()
 
     def set_search(self, term):
         self.params.update({'search': term})
@@ -115,18 +1086,62 @@ class BBS:
     async def search(self, term, orderby="RECENT"):
         self.set_search(term)
         self.set_param("orderby", orderby)
-        await self._populate_results()
+        with STATS.span("search (first result)"):
+            await self._populate_results()
         return self.posts
 
+    async def _search_index(self):
+        """rows from the local index, or [] on a miss"""
+        if self.index is None:
+            return []
+        with STATS.span("index search"):
+            found = await self.loop.run_in_executor(
+                None, self.index.search, self.params.get('search', ''),
+                self.params.get('cat'), self.params.get('sub'), self.orderby)
+        STATS.count("index hits" if found else "index misses")
+        return found
+
+    @staticmethod
+    def _parse_listing(raw):
+        """returns the pdat rows of a listing page. [] if there are none
+
+        raises json.decoder.JSONDecodeError if the site changed on us
+        """
+        start = raw.find(BBS.POSTS_START)
+        end = raw.find(BBS.POSTS_END, start)
+        if start == -1 or end == -1:  # no results
+            return []
+        with STATS.span("pdat parse"):
+            return parse_js_array(raw[start + len(BBS.POSTS_START):end])
+
     async def _populate_results(self):
-        raw = await self._get()
-        soup = BeautifulSoup(raw, "html.parser")
         async def self_destruct():
             raise RuntimeError("KABOOM!")
 
-        try:
-            js_posts = re.search(BBS.RE_POSTS, raw).group(1)
-        except AttributeError:  # no results
+        found = await self._search_index()
+        self.from_index = bool(found)
+        if not found:  # cache miss. go live
+            with STATS.span("listing fetch"):
+                raw = await self._get()
+            try:
+                posts = self._parse_listing(raw)
+            except json.decoder.JSONDecodeError as e:
+                print('erroring page in ' + ERROR_PATH)
+                with open(ERROR_PATH, 'w+') as f:
+                    f.write(raw)
+                    f.write('\n\n' + '{:-^50}'.format('scraped'))
+                    f.write('{} at {}:\n'.format(e.msg, e.pos))
+                    f.write(e.doc)
+                    f.write('\n\n' + '-'*50)
+                self.load_tasks = ['Looks like there was an error :/ '
+                                   'This is just scraping the forum, '
+                                   'so there is the possibility this\'ll break']
+                return
+            found = [(p, None, None) for p in posts]
+            if posts and self.index is not None:
+                self.loop.run_in_executor(None, self.index.add_rows, posts)
+
+        if not found:
             self.load_tasks = [
                 "No results found", "I said there're no results",
                 ":neutral_face:", ":confused:", "what..", 
@@ -135,7 +1150,7 @@ class BBS:
                 "filling a bunch of flavor text", "for no reason", "...",
                 "..right?", "...", "...", "...", "well..", 
                 "I guess you could look at some of these..",
-                *[(msg, self._post_to_embed(p)) for msg, p in self.picks],
+                *load_picks(),
                 ("And there's so much more!", 
                  discord.Embed(title='Now go make some of your own!')),
                 ("this message will self-destruct in...", discord.Embed(title='3')),
@@ -144,96 +1159,32 @@ class BBS:
             ]
             self.load_tasks += self.load_tasks[::-1][:-1]
             self.posts = []
-            self.embeds = []
-            self.locks = []
             return
 
-        cleanse = [('\r', ''), ('\n', ''), ('\t', ''), ('`', '"'),
-                   (',,', ',null,'), (',]', ']')]
-        for p, r in cleanse:
-            js_posts = js_posts.replace(p, r)
-
-        try:
-            posts = json.loads(js_posts)
-        except json.decoder.JSONDecodeError as e:
-            print('erroring page in ' + ERROR_PATH)
-            with open(ERROR_PATH, 'w+') as f:
-                f.write(raw)
-                f.write('\n\n' + '{:-^50}'.format('scraped'))
-                f.write(js_posts)
-                f.write('\n\n' + '-'*50)
-            self.load_tasks = ['Looks like there was an error :/ '
-                               'This is just scraping the forum, '
-                               'so there is the possibility this\'ll break']
-            return
-        # [38386, 28997, `Poop Blaster`,"thumbs/pico38385.png",
-        #  0:pid 1:tid 2:title 3:thumb
-        # 64,64,"2017-03-18",15018,"chase","2017-03-19",9551,
-        # 4:w 5:h 6:date 7:aid 8:author 9:date2 10:uid
-        # "kittenm4ster",0,2,0,
-        # 11:last 12:likes 13:comments 14:?
-        # 7,3,38385,[],0]
-        # 15:cat 16:subcat 17:cid 18:tags 19:resolved
-
-        self.posts = [{"PID": p[0],
-                       "TID": p[1],
-                       "TITLE": p[2],
-                       "DESC": None,  # temp
-                       "THUMB": self.url + quote('..' + p[3] if p[3][0] == '/' else p[3]),
-                       "DATE": p[6],
-                       "AID": p[7],
-                       "AUTHOR": p[8],
-                       "AUTHOR_URL": self.url + "?uid={}".format(p[7]),
-                       "AUTHOR_PIC": "https://www.lexaloffle.com/bimg/pi/pi28.png",  # temp
-                       "STARS": p[12],
-                       "CC": False,  # temp
-                       "COMMENTS": p[13],
-                       # "FAV": p[14]  # used in generate_cart_preview.
-                       # apparently is also the cart id sometimes?
-                       "CAT": p[15],
-                       "SUB": p[16],
-                       "CID": p[17],
-                       "PNG": None if ((p[15] not in (6,7)) or p[17] is None) else
-                              self.url + ('cposts/{}/{}.p8.png' if p[15] == 7 else
-                                          'cposts/{}/cpost{}.png').format(p[17] // 10000, p[17]),
-                       "CART_TITLE": None,  # temp
-                       "CART_AUTHOR": None,  # temp
-                       "TAGS": p[18],
-                       "STATUS": "",
-                       "URL": "{}?tid={}".format(self.url, p[1]),
-                       "PARAM": {"tid": p[1]}} for p in posts]
-
-        for p in self.posts:
-            self.embeds.append(None)
-            self.locks.append(Lock())
-
-        async def gen_embed(i):
-            await self._populate_post(i)
-            return self.embeds[i]
-
-        self.load_tasks.extend(gen_embed(i) for i in range(len(self.embeds)))
+        self._add_page(1, found)
 
         await self._populate_post(0)
         self.queue_area(0)
 
-    def _post_to_embed(self, post):
+    @staticmethod
+    def _post_to_embed(post):
         # this whole embed business should be moved into the Pico8 class
         p = post
 
-        embed = discord.Embed(title=p['TITLE'], url=p['URL'],
-                              description=p['DESC'] if p['DESC'].strip() else None)
-        embed.set_author(name=p['AUTHOR'], url=p['AUTHOR_URL'],
-                         icon_url=p['AUTHOR_PIC'])
-        tagline = ("🔖 " if p['TAGS'] else "No tags") + (', '.join(p['TAGS']))
+        embed = discord.Embed(title=p.title, url=p.url,
+                              description=p.desc if p.desc.strip() else None)
+        embed.set_author(name=p.author, url=p.author_url,
+                         icon_url=p.author_pic)
+        tagline = ("🔖 " if p.tags else "No tags") + (', '.join(p.tags))
         footer_kw = {}
-        if p['CART_TITLE'] is not None:
-            embed.set_thumbnail(url=p['PNG'])
-            embed.add_field(name=p['CART_TITLE'], inline=True,
-                            value='by {}'.format(p['CART_AUTHOR']))
-            embed.set_image(url=p['THUMB'])
-            cc = self.url[:-5] + "/gfx/set_cc{}.png".format(1 if p['CC'] else 0)
+        if p.cart_title is not None:
+            embed.set_thumbnail(url=p.png)
+            embed.add_field(name=p.cart_title, inline=True,
+                            value='by {}'.format(p.cart_author))
+            embed.set_image(url=p.thumb)
+            cc = BBS.BASE[:-5] + "/gfx/set_cc{}.png".format(1 if p.cc else 0)
             footer_kw['icon_url'] = cc
-        embed.set_footer(text="{} - {} ⭐ - {}".format(p['DATE'], p['STARS'], 
+        embed.set_footer(text="{} - {} ⭐ - {}".format(p.date, p.stars, 
                                                        tagline),
                          **footer_kw)
         return embed
@@ -243,51 +1194,109 @@ class BBS:
         index = self._get_post_index(index_or_id)
         post = post or self.posts[index]
         # needlessly complicated
-        if post['STATUS'] == 'success':
+        if post.status == 'success':
             return True
-        async with self.locks[index]:
-            if post['STATUS'] == 'success':
+        async with post.lock:
+            if post.status == 'success':
                 return True
-            post['STATUS'] = 'processing'
+            post.status = 'processing'
+            start = time.perf_counter()
             try:
-                await self._load_post(index)
+                if self._known_post(post) and await self._load_cart(post):
+                    STATS.count("thread fetches skipped")
+                else:
+                    await self._load_post(index)
+                if self.images is not None:
+                    await self.images.localize(post)
             except Exception as e:
-                post['STATUS'] = 'failed'
+                post.status = 'failed'
+                if post.failures:
+                    BBS_CIRCUIT.retries += 1
+                post.failures += 1
+                # full jitter so open searches don't all retry in step
+                backoff = min(BBS.RETRY_CAP, BBS.RETRY_BASE * 2 ** post.failures)
+                post.retry_at = time.monotonic() + random.uniform(0, backoff)
                 raise e
             else:
-                self.embeds[index] = self._post_to_embed(post)
-            post['STATUS'] = 'success'
+                post.failures = 0
+                with STATS.span("embed build"):
+                    post.embed = self._post_to_embed(post)
+                STATS.record("post load", time.perf_counter() - start)
+                self.loaded.add(index)
+                if self.index is not None:
+                    self.loop.run_in_executor(None, self.index.set_desc,
+                                              post.pid, post.desc, post.cc)
+            post.status = 'success'
+
+    def _known_post(self, post):
+        """whether the thread has nothing to add but the cart title/author"""
+        return (self.images is not None and post.desc is not None and
+                post.cc is not None and post._author_pic is not None)
+
+    async def _load_cart(self, post):
+        """fills in the cart title/author from the cart png itself
+
+        returns whether they're known now. only worth calling when
+        it saves fetching the thread, which fills them in anyway
+        """
+        if post.png is None or post.cart_title is not None:
+            return True
+        if self.images is None or np is None or post.cat != 7:
+            return False
+        try:
+            data = await self.images.fetch(post.png)
+            with STATS.span("cart decode"):
+                title, author = await self.loop.run_in_executor(
+                    None, cart_label, data)
+        except (CartDecodeError, ImageFetchError, BBSDown, aiohttp.ClientError,
+                asyncio.TimeoutError, OSError, ValueError):
+            return False
+        if title is None:
+            return False
+        post.cart_title = title
+        post.cart_author = author or post.author
+        return True
 
     async def _load_post(self, index):
         post = self.posts[index]
-        raw = await self._get_post(index)
+        with STATS.span("post fetch"):
+            raw = await self._get_post(index)
+        with STATS.span("soup parse"):
+            self._parse_post(post, raw)
+
+    def _parse_post(self, post, raw):
+        """fills the post in from its thread's html"""
         soup = BeautifulSoup(raw, "html.parser")
 
-        main = soup.find('div', id='p{}'.format(post['PID']))
+        main = soup.find('div', id='p{}'.format(post.pid))
         # author pic
         ava = main.center.img['src']
         if not ava.startswith('http'):
             ava = self.url[:-5] + quote(ava)
-        post['AUTHOR_PIC'] = ava
+        post.author_pic = ava
+        if self.images is not None:
+            self.images.set_author_pic(post.aid, ava)
 
         cart = soup.find('div', id=re.compile(r'infodiv*'))
         if cart:
             bg = re.search(BBS.RE_CART_BG, cart['style']).group(1)
             # image
-            if not post['THUMB'].endswith(bg):
-                post['THUMB'] = self.url + quote(bg)
+            if not post.thumb.endswith(bg):
+                post.thumb = self.url + quote(bg)
             # thumbnail
             pngel = cart.parent.find_next_sibling()
             png = pngel.a['href']
-            if post['PNG'] is None or not post['PNG'].endswith(png):
-                post['PNG'] = self.url[:-5] + quote(png)
+            if post.png is None or not post.png.endswith(png):
+                post.png = self.url[:-5] + quote(png)
             # CC
             cc = pngel.find_next_sibling().find_next_sibling()
-            post['CC'] = cc.img['src'] == '/gfx/set_cc1.png'
+            post.cc = cc.img['src'] == '/gfx/set_cc1.png'
             # cart title / author
             links = cart.find_all('a')
-            post['CART_TITLE'] = links[0].text
-            post['CART_AUTHOR'] = links[1].text
+            post.cart_title = links[0].text
+            post.cart_author = links[1].text
+        else:
+            post.cc = False
 
         # description
         # try remove the cart(s)
@@ -320,16 +1329,16 @@ class BBS:
             for p, r in cleanse:
                 ps[i] = ps[i].replace(p, r)
 
-        post['DESC'] = '\n\n'.join(ps)[:150]
-        if post['DESC'].strip():
-            post['DESC'] += '...'
+        post.desc = '\n\n'.join(ps)[:150]
+        if post.desc.strip():
+            post.desc += '...'
 
     def _get_post_index(self, index_or_id):
         try:
             self.posts[index_or_id]
         except TypeError:
             for n, p in enumerate(self.posts):
-                if p["PARAM"]['tid'] == index_or_id:
+                if p.tid == index_or_id:
                     return n
         else:
             return index_or_id
@@ -338,28 +1347,58 @@ class BBS:
     async def _get_post(self, index_or_id):
         index = self._get_post_index(index_or_id)
         post = self.posts[index]
-        param = post["PARAM"]
-        return await self._get(param)
+        return await self._get(post.param)
 
     async def _get(self, params=None):
         params = params or self.params
-        async with aiohttp.get(self.url, params=params) as r:
-            return await r.text()
+        r, text = await _request(self.url, params)
+        return text
+
+    async def _get_if_changed(self, validators, params=None):
+        """conditional GET using the ETag/Last-Modified in validators
+
+        returns None if the page hasn't changed. updates validators otherwise
+        """
+        params = params or self.params
+        headers = {}
+        if validators.get('ETAG'):
+            headers['If-None-Match'] = validators['ETAG']
+        if validators.get('MODIFIED'):
+            headers['If-Modified-Since'] = validators['MODIFIED']
+        r, text = await _request(self.url, params, headers)
+        if r.status == 304:
+            return None
+        validators['ETAG'] = r.headers.get('ETag')
+        validators['MODIFIED'] = r.headers.get('Last-Modified')
+        return text
 
     async def _queue_runner(self):
         while True:
             if self.queue:
                 working_group = []
                 for i in self.queue[:]:
-                    status = self.posts[i]["STATUS"]
-                    if status == 'success':
+                    if self.posts[i] is None:  # page dropped or not here yet
+                        self.queue.remove(i)
+                        continue
+                    post = self.posts[i]
+                    if post.status == 'success':
                         self.queue.remove(i)
-                    if status in ('', 'failed'):
+                    elif post.status == 'failed' and \
+                         time.monotonic() < post.retry_at:
+                        continue  # still backing off
+                    if post.status in ('', 'failed'):
                         working_group.append(i)
                 for i in working_group:
-                    self.loop.create_task(self._populate_post(i))
+                    self.loop.create_task(self._try_populate_post(i))
             await asyncio.sleep(.5)
 
+    async def _try_populate_post(self, i):
+        """_populate_post for background loads. failures are retried later"""
+        try:
+            await self._populate_post(i)
+        except Exception:
+            pass
+
     def set_param(self, param, value_name):
         self.params[param] = self.get_value(param, value_name)
 
@@ -437,6 +1476,62 @@ Card:
 """
 
 
+FILTERS = {
+    "cat": {
+        "pico8": "PICO8", "p8": "PICO8",
+        "voxatron": "VOXATRON", "vox": "VOXATRON",
+    },
+    "sub": {
+        "jams": "JAMS",
+        "snippets": "SNIPPETS",
+        "discussions": "DISCUSSIONS", "discuss": "DISCUSSIONS",
+        "blogs": "BLOGS",
+        "inprogress": "WIP", "wip": "WIP",
+        "collaboration": "COLLABORATION", "collab": "COLLABORATION",
+        "arts": "ART",
+        "support": "SUPPORT",
+        "workshops": "WORKSHOPS", "wkshop": "WORKSHOPS",
+        "shop": "WORKSHOPS",
+        "music": "MUSIC",
+        "cartridges": "CARTRIDGES", "carts": "CARTRIDGES"
+    },
+    "orderby": {
+        "new": "RECENT",
+        "rating": "FEATURED",
+        "relevance": "RELEVANCE", "best": "RELEVANCE"
+    }
+}
+
+
+def parse_filters(filters):
+    """splits "?p8:carts search terms" into (params, search_terms)
+
+    raises ValueError if a filter type is given more than once
+    """
+    params = {}
+    if not filters.startswith('?'):
+        return params, filters
+    filters = filters if ' ' in filters else filters + ' '
+    filters, search_terms = filters.split(' ', 1)
+    filters = filters[1:].lower().split(':')
+    for f in filters:
+        for k, ch in FILTERS.items():
+            if f in ch:
+                if k in params:
+                    raise ValueError("You can only have one "
+                                     "of each filter type.")
+                params[k] = ch[f]
+    return params, search_terms
+
+
+def _feed_key(filters):
+    """turns system/category filters into a "CAT:SUB" notification feed"""
+    params, search_terms = parse_filters(filters)
+    if search_terms.strip():
+        raise ValueError("Notifications only take filters, ex: ?p8:carts")
+    return "{}:{}".format(params.get("cat", "PICO8"), params.get("sub", ""))
+
+
 class Pico8:
     """cog to search Lexaloffle's bulletin board system
     and notify when new PICO-8 carts are uploaded
@@ -458,6 +1553,292 @@ class Pico8:
         self.bot = bot
         self.settings = dataIO.load_json(SETTINGS_PATH)
         self.searches = []
+        self.index = CartIndex(INDEX_PATH)
+        self.images = ImageCache(bot, self.settings["IMAGES"])
+        load_picks()
+        self.feed_validators = {}
+        self.crawler = self.bot.loop.create_task(self.crawl_index())
+        self.watcher = self.bot.loop.create_task(self.watch_new_posts())
+
+    def __unload(self):
+        self.crawler.cancel()
+        self.watcher.cancel()
+        self.index.close()
+        self.images.save()
+
+    def _save(self):
+        dataIO.save_json(SETTINGS_PATH, self.settings)
+
+    async def crawl_index(self):
+        """keeps the local cart index fresh in the background"""
+        await self.bot.wait_until_ready()
+        try:
+            while True:
+                conf = self.settings["INDEX"]
+                if conf["ENABLED"]:
+                    for cat, sub in conf["CATEGORIES"]:
+                        for orderby in ("RECENT", "FEATURED"):
+                            try:
+                                await self._crawl_listing(cat, sub, orderby)
+                            except (BBSDown, aiohttp.ClientError,
+                                    asyncio.TimeoutError) as e:
+                                print("Pico8: couldn't crawl {} {} {}: {}"
+                                      .format(cat, sub, orderby, e))
+                await asyncio.sleep(conf["INTERVAL"])
+        except asyncio.CancelledError:
+            pass
+
+    async def _crawl_listing(self, cat, sub, orderby):
+        """pulls listing pages into the index until nothing new shows up
+        (recent) or the page limit is hit"""
+        conf = self.settings["INDEX"]
+        params = {"cat": cat, "orderby": orderby}
+        if sub:
+            params["sub"] = sub
+        bbs = BBS(self.bot.loop, "", params=params)
+        for page in range(1, conf["PAGES"] + 1):
+            bbs.params["page"] = page
+            raw = await bbs._get()
+            try:
+                rows = bbs._parse_listing(raw)
+            except json.decoder.JSONDecodeError:
+                print("Pico8: couldn't parse {} {} listing page {}"
+                      .format(cat, sub, page))
+                return
+            if not rows:
+                return
+            new = await self.bot.loop.run_in_executor(None, self.index.add_rows,
+                                                      rows)
+            if orderby == "RECENT" and not new:
+                return
+            await asyncio.sleep(conf["DELAY"])
+
+    async def watch_new_posts(self):
+        """polls each subscribed feed once per interval
+        and fans new posts out to every channel subscribed to it"""
+        await self.bot.wait_until_ready()
+        try:
+            while True:
+                conf = self.settings["NOTIFY"]
+                feeds = {}
+                for channel_id, keys in conf["CHANNELS"].items():
+                    for key in keys:
+                        feeds.setdefault(key, []).append(channel_id)
+                for key, channel_ids in feeds.items():
+                    try:
+                        await self._check_feed(key, channel_ids)
+                    except (BBSDown, aiohttp.ClientError,
+                            asyncio.TimeoutError) as e:
+                        print("Pico8: couldn't check {} for new posts: {}"
+                              .format(key, e))
+                await asyncio.sleep(conf["INTERVAL"])
+        except asyncio.CancelledError:
+            pass
+
+    async def _check_feed(self, key, channel_ids):
+        conf = self.settings["NOTIFY"]
+        cat, sub = key.split(':')
+        params = {"cat": cat, "orderby": "RECENT"}
+        if sub:
+            params["sub"] = sub
+        images = self.images if self.settings["IMAGES"]["ENABLED"] else None
+        bbs = BBS(self.bot.loop, "", params=params, images=images)
+        validators = self.feed_validators.setdefault(key, {})
+        raw = await bbs._get_if_changed(validators)
+        if raw is None:  # 304. nothing new
+            return
+        try:
+            rows = bbs._parse_listing(raw)
+        except json.decoder.JSONDecodeError:
+            print("Pico8: couldn't parse the {} feed".format(key))
+            return
+
+        seen = conf["SEEN"].get(key)
+        pids = [p[0] for p in rows]
+        if seen is None:  # first look. don't flood the channels
+            conf["SEEN"][key] = pids[:SEEN_LIMIT]
+            self._save()
+            return
+        seen_set = set(seen)
+        new = [p for p in rows if p[0] not in seen_set]
+        if not new:
+            return
+        conf["SEEN"][key] = (pids + [p for p in seen if p not in pids])[:SEEN_LIMIT]
+        self._save()
+        if self.settings["INDEX"]["ENABLED"]:
+            self.bot.loop.run_in_executor(None, self.index.add_rows, new)
+
+        channels = list(filter(None, map(self.bot.get_channel, channel_ids)))
+        for row in reversed(new):  # oldest first
+            embed = await self._new_post_embed(bbs, row)
+            for channel in channels:
+                try:
+                    await self.bot.send_message(channel, "New on the BBS!",
+                                                embed=embed)
+                except discord.HTTPException:
+                    pass
+
+    async def _new_post_embed(self, bbs, row):
+        """loads a post once so every channel gets the same embed"""
+        post = Post(row)
+        bbs.posts = [post]
+        try:
+            await bbs._populate_post(0)
+        except Exception:
+            post.desc = post.desc or ''
+            return bbs._post_to_embed(post)
+        return post.embed
+
+    @checks.admin_or_permissions(manage_server=True)
+    @commands.group(pass_context=True, no_pm=True)
+    async def bbsnotify(self, ctx):
+        """Get notified in this channel when new posts hit the BBS"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @bbsnotify.command(pass_context=True, name="add", no_pm=True)
+    async def bbsnotify_add(self, ctx, filters="?p8:carts"):
+        """Notify this channel of new posts in a category
+
+        uses the same system/category filters as [p]bbs. ex: ?p8:wip"""
+        channel = ctx.message.channel
+        try:
+            key = _feed_key(filters)
+        except ValueError as e:
+            return await self.bot.say(str(e))
+        keys = self.settings["NOTIFY"]["CHANNELS"].setdefault(channel.id, [])
+        if key in keys:
+            return await self.bot.say("This channel already gets {} posts"
+                                      .format(key))
+        keys.append(key)
+        self._save()
+        await self.bot.say("New {} posts will show up here".format(key))
+
+    @bbsnotify.command(pass_context=True, name="remove", no_pm=True)
+    async def bbsnotify_remove(self, ctx, filters="?p8:carts"):
+        """Stop notifying this channel of new posts in a category"""
+        channel = ctx.message.channel
+        try:
+            key = _feed_key(filters)
+        except ValueError as e:
+            return await self.bot.say(str(e))
+        subs = self.settings["NOTIFY"]["CHANNELS"]
+        keys = subs.get(channel.id, [])
+        if key not in keys:
+            return await self.bot.say("This channel doesn't get {} posts"
+                                      .format(key))
+        keys.remove(key)
+        if not keys:
+            del subs[channel.id]
+        self._save()
+        await self.bot.say("No more {} posts here".format(key))
+
+    @bbsnotify.command(pass_context=True, name="list", no_pm=True)
+    async def bbsnotify_list(self, ctx):
+        """List the categories this channel is notified of"""
+        keys = self.settings["NOTIFY"]["CHANNELS"].get(ctx.message.channel.id)
+        if not keys:
+            return await self.bot.say("This channel isn't notified of anything")
+        await self.bot.say("This channel gets new posts from: " + ", ".join(keys))
+
+    @checks.is_owner()
+    @commands.group(pass_context=True)
+    async def bbsset(self, ctx):
+        """Pico8 settings"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @bbsset.command(name="index")
+    async def bbsset_index(self, on_off: bool=None):
+        """Toggle the local cart index crawler
+
+        When on, bbs searches are answered from the local index
+        and only go to the site when nothing local matches."""
+        conf = self.settings["INDEX"]
+        conf["ENABLED"] = not conf["ENABLED"] if on_off is None else on_off
+        self._save()
+        count = await self.bot.loop.run_in_executor(None, len, self.index)
+        await self.bot.say("Local cart index is now {}. {} posts indexed."
+                           .format("on" if conf["ENABLED"] else "off", count))
+
+    @bbsset.command(name="images")
+    async def bbsset_images(self, on_off: bool=None):
+        """Toggle caching BBS images locally
+
+        Remembers author avatars too, so repeat authors load faster.
+        Set [p]bbsset mirror so embeds use the cached copies"""
+        conf = self.settings["IMAGES"]
+        conf["ENABLED"] = not conf["ENABLED"] if on_off is None else on_off
+        self._save()
+        await self.bot.say("Image cache is now {}. {:.1f}/{} MB used"
+                           .format("on" if conf["ENABLED"] else "off",
+                                   self.images.total / 1024 / 1024,
+                                   conf["MAX_MB"]))
+
+    @bbsset.command(name="mirror")
+    async def bbsset_mirror(self, channel: discord.Channel=None):
+        """Channel to upload cached images to for embeds
+
+        Leave blank to point embeds back at the BBS"""
+        self.settings["IMAGES"]["MIRROR_CHANNEL"] = channel and channel.id
+        self._save()
+        await self.bot.say("Images are now mirrored in {}"
+                           .format(channel.mention if channel else "nowhere"))
+
+    @bbsset.command(name="health")
+    async def bbsset_health(self):
+        """How the BBS has been holding up"""
+        c = BBS_CIRCUIT
+        state = "down (backing off)" if c.is_open else "up"
+        await self.bot.say("```\n{} is {}\n"
+                           "times it went down:   {}\n"
+                           "time spent down:      {:.0f}s\n"
+                           "requests skipped:     {}\n"
+                           "post loads retried:   {}\n```"
+                           .format(c.name, state, c.trips, c.open_time,
+                                   c.short_circuits, c.retries))
+
+    @bbsset.command(name="interval")
+    async def bbsset_interval(self, seconds: int):
+        """How often to check the BBS for new posts to notify about"""
+        self.settings["NOTIFY"]["INTERVAL"] = max(60, seconds)
+        self._save()
+        await self.bot.say("Checking for new posts every {} seconds"
+                           .format(self.settings["NOTIFY"]["INTERVAL"]))
+
+    @bbsset.command(pass_context=True, name="stats")
+    async def bbsset_stats(self, ctx, option: str=None):
+        """How long each stage of bbs searches takes (in ms)
+
+        [p]bbsset stats json   uploads everything as a json file
+        [p]bbsset stats reset  starts counting over"""
+        if option == "reset":
+            STATS.reset()
+            return await self.bot.say("Stats reset")
+
+        summary = STATS.summary()
+        c = BBS_CIRCUIT
+        summary["CIRCUIT"] = {"OPEN": c.is_open, "TRIPS": c.trips,
+                              "OPEN_TIME": c.open_time,
+                              "SHORT_CIRCUITS": c.short_circuits,
+                              "RETRIES": c.retries}
+        if option == "json":
+            dataIO.save_json(STATS_PATH, summary)
+            return await self.bot.send_file(ctx.message.channel, STATS_PATH)
+
+        if not summary["STAGES"]:
+            return await self.bot.say("No searches timed yet")
+        width = max(map(len, summary["STAGES"]))
+        lines = ["{:<{w}} {:>6} {:>8} {:>8} {:>8}"
+                 .format("stage", "count", "p50", "p95", "p99", w=width)]
+        for stage, st in summary["STAGES"].items():
+            lines.append("{:<{w}} {:>6} {:>8.1f} {:>8.1f} {:>8.1f}"
+                         .format(stage, st["COUNT"], st["P50"], st["P95"],
+                                 st["P99"], w=width))
+        lines.append("")
+        for counter, n in summary["COUNTERS"].items():
+            lines.append("{:<{w}} {:>6}".format(counter, n, w=width))
+        await self.bot.say("```\n{}\n```".format("\n".join(lines)))
 
     @commands.command(pass_context=True, no_pm=True, aliases=['pico8'])
     async def bbs(self, ctx, *, filters="?p8:recent", search_terms=""):
@@ -478,55 +1859,23 @@ class Pico8:
           Order:
               new [default]
               rating
+              relevance (best)  [only with the local index]
         """
         author = ctx.message.author
         server = ctx.message.server
         msg = ctx.message
 
-        choices = {
-            "cat": {
-                "pico8": "PICO8", "p8": "PICO8",
-                "voxatron": "VOXATRON", "vox": "VOXATRON",
-            },
-            "sub": {
-                "jams": "JAMS",
-                "snippets": "SNIPPETS",
-                "discussions": "DISCUSSIONS", "discuss": "DISCUSSIONS",
-                "blogs": "BLOGS",
-                "inprogress": "WIP", "wip": "WIP",
-                "collaboration": "COLLABORATION", "collab": "COLLABORATION",
-                "arts": "ART",
-                "support": "SUPPORT",
-                "workshops": "WORKSHOPS", "wkshop": "WORKSHOPS",
-                "shop": "WORKSHOPS",
-                "music": "MUSIC",
-                "cartridges": "CARTRIDGES", "carts": "CARTRIDGES"
-            },
-            "orderby": {
-                "new": "RECENT",
-                "rating": "FEATURED"
-            }
-        }
-
-        params = {}
-
-        if filters.startswith('?'):
-            filters = filters if ' ' in filters else filters + ' '
-            filters, search_terms = filters.split(' ', 1)
-            filters = filters[1:].lower().split(':')
-            for f in filters:
-                for k, ch in choices.items():
-                    if f in ch:
-                        if k in params:
-                            return await self.bot.say("You can only have one"
-                                                      "of each filter type.")
-                        params[k] = ch[f]
-        else:
-            search_terms = filters
+        try:
+            params, search_terms = parse_filters(filters)
+        except ValueError as e:
+            return await self.bot.say(str(e))
 
         await self.bot.add_reaction(msg, '🔎')
 
-        async with BBS(self.bot.loop, search_terms, params=params) as bbs:
+        index = self.index if self.settings["INDEX"]["ENABLED"] else None
+        images = self.images if self.settings["IMAGES"]["ENABLED"] else None
+        async with BBS(self.bot.loop, search_terms, params=params,
+                       index=index, images=images) as bbs:
             # self.searches.append(bbs)  # add caching later?
             await asyncio.gather(
                 repl.interactive_results(self.bot, ctx, bbs.load_tasks, 
@@ -536,7 +1885,7 @@ class Pico8:
 
 
 def check_folders():
-    paths = ("data/pico8", )
+    paths = ("data/pico8", IMAGES_PATH)
     for path in paths:
         if not os.path.exists(path):
             print("Creating {} folder...".format(path))
@@ -544,7 +1893,7 @@ def check_folders():
 
 
 def check_files():
-    default = {}
+    default = DEFAULT_SETTINGS
 
     if not dataIO.is_valid_json(SETTINGS_PATH):
         print("Creating default pico8 settings.json...")
@@ -0,0 +1,91 @@
+"""regression + fuzz checks for pico8.parse_js_array
+
+needs the environment the cog loads in (discord.py, bs4, Red's cogs package).
+run with `python pico8/test_parse_js_array.py` or pytest
+"""
+import __main__
+import os
+import random
+import sys
+
+if not hasattr(__main__, 'send_cmd_help'):  # cogs import it from red.py
+    async def send_cmd_help(ctx):
+        pass
+    __main__.send_cmd_help = send_cmd_help
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from pico8 import parse_js_array
+
+
+REGRESSIONS = [
+    ('[`Hello,,World`]', ['Hello,,World']),
+    ('[`a,]b`]', ['a,]b']),
+    ('[`[,x`,,]', ['[,x', None]),
+    ('[1,,2]', [1, None, 2]),
+    ('[,1]', [None, 1]),
+    ('[1,2,]', [1, 2]),
+    ('[1 , ,\r\n\t2]', [1, None, 2]),
+    ('[`say "hi"`]', ['say "hi"']),
+    ('[`tick \\` tock`]', ['tick ` tock']),
+    ('[`back\\\\slash`,`\\$5`]', ['back\\slash', '$5']),
+    ('["dq, `string`",,]', ['dq, `string`', None]),
+    ('[`line\r\nbreak`]', ['line\r\nbreak']),
+    ('[ ,]', [None]),
+    ('[1,,,2]', [1, None, None, 2]),
+    ('[`a","b`]', ['a","b']),
+    ('["a`,`b"]', ['a`,`b']),
+    ('[\r\n\t\t[1,`x`,,],\r\n\t\t[2,"y"],\r\n\t\t]', [[1, 'x', None], [2, 'y']]),
+]
+
+CHARS = 'ab ,,]][[`"\\\r\n\t$'
+SPACE = ('', '', ' ', '\r\n\t\t')
+
+
+def _random_string(rng):
+    return ''.join(rng.choice(CHARS) for _ in range(rng.randrange(8)))
+
+
+def _random_value(rng, depth=0):
+    roll = rng.random()
+    if depth < 3 and roll < 0.25:
+        return [_random_value(rng, depth + 1) for _ in range(rng.randrange(5))]
+    if roll < 0.45:
+        return None
+    if roll < 0.65:
+        return rng.randrange(-1000, 1000)
+    return _random_string(rng)
+
+
+def _to_js(value, rng):
+    """value as a js literal, with holes for None and stray whitespace"""
+    if value is None:
+        return ''  # an elision. only valid inside an array
+    if isinstance(value, list):
+        items = [_to_js(v, rng) for v in value]
+        trailing = value and (value[-1] is None or rng.random() < 0.3)
+        pad = rng.choice(SPACE)
+        return '[' + (pad + ',' + pad).join(items) + (',' if trailing else '') + ']'
+    if isinstance(value, str):
+        if rng.random() < 0.2:
+            return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        return '`' + value.replace('\\', '\\\\').replace('`', '\\`') + '`'
+    return str(value)
+
+
+def test_regressions():
+    for js, expected in REGRESSIONS:
+        assert parse_js_array(js) == expected, js
+
+
+def test_fuzz(runs=5000, seed=8):
+    rng = random.Random(seed)
+    for _ in range(runs):
+        value = [_random_value(rng) for _ in range(rng.randrange(6))]
+        js = _to_js(value, rng)
+        assert parse_js_array(js) == value, js
+
+
+if __name__ == '__main__':
+    test_regressions()
+    test_fuzz()
+    print('ok')
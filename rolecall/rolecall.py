@@ -4,13 +4,19 @@ from discord.ext import commands
 from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
 import asyncio
+import json
 import logging
 import os
+import re
+import time
+import zlib
+from collections import OrderedDict, deque
 from copy import deepcopy
 
 log = logging.getLogger("red.rolecall")
 
 SETTINGS_PATH = "data/rolecall/settings.json"
+CHECKPOINT_PATH = "data/rolecall/reconciled.json"
 DEFAULT_SETTINGS = {
     "ROLEBOARD": None,
     "MSGS": {}
@@ -19,22 +25,46 @@ DEFAULT_SETTINGS = {
 # just make a constructor. we're treating it as an object anyway
 MSG_STRUCT = {
     "ID": None,
-    "ROLE": None
+    "CHANNEL": None,
+    "ROLE": None,
+    "AUTHOR": None,
+    "EMOJI": None
 }
 
+CUSTOM_EMOJI = re.compile(r"<:\w+:(\d+)>")
+ROLE_BATCH_DELAY = 1.5  # seconds of reactions to collect before editing roles
+ROLE_RETRIES = 3
+RECONCILE_WORKERS = 2
+# gateway events for reactions on messages outside the client's cache
+RAW_REACTIONS = {"MESSAGE_REACTION_ADD": True, "MESSAGE_REACTION_REMOVE": False}
 
-async def post_role(self, role: discord.Role, channel: discord.Channel,
-                    author: discord.Member, content=None, embed=None):
-    m = await self.bot.send_message(channel, content, embed=embed)
-    post = {
+
+async def post_role(bot, role: discord.Role, channel: discord.Channel,
+                    author: discord.Member, emoji, content=None, embed=None):
+    """posts a roleboard entry and returns its MSG_STRUCT"""
+    m = await bot.send_message(channel, content, embed=embed)
+    post = deepcopy(MSG_STRUCT)
+    post.update({
         "ID": m.id,
-        "ROLE": role,
+        "CHANNEL": channel.id,
+        "ROLE": role.id,
         "AUTHOR": author.id,
-        "EMOJI": None
-    }
-
-def get_channel_by_name(server, name):
-    channels = [c for c in server.channels if c.name==name]
+        "EMOJI": emoji_key(emoji)
+    })
+    return m, post
+
+
+def emoji_key(emoji):
+    """what an emoji is stored as: the character(s) for unicode emoji,
+    the id for custom ones"""
+    if isinstance(emoji, str):
+        m = CUSTOM_EMOJI.match(emoji)
+        return m.group(1) if m else emoji
+    return emoji.id
+
+def get_channel_by_name(index, name):
+    """index is the server's ServerIndex"""
+    channels = index.channels.get(name.casefold(), ())
     if len(channels) > 1:
         raise MultipleChannelsWithThatName("There are multiple channels "
                                            "with the name: " + name)
@@ -81,17 +111,186 @@ TODO: Make Entry/Call a class that handles the data for me (what is an entry on
 """
 
 class Entry:
-    """Entry on the roleboard"""
+    """Entry on the roleboard
 
-    def __init__(self, bot, save_point, server, channel, author):
-        pass
+    save_point is its MSG_STRUCT in the settings"""
+
+    def __init__(self, save_point, server_id):
+        self.save_point = save_point
+        self.server_id = server_id
+
+    @property
+    def id(self):
+        return self.save_point["ID"]
+
+    @property
+    def channel_id(self):
+        return self.save_point["CHANNEL"]
+
+    @property
+    def role_id(self):
+        return self.save_point["ROLE"]
+
+    @property
+    def emoji(self):
+        return self.save_point["EMOJI"]
 
 
 class RoleBoard:
-    """Server-based Roleboard"""
+    """Server-based Roleboard
+
+    keeps its entries in index, {(message id, emoji key): Entry},
+    which is shared between servers so a reaction is one lookup
+    """
 
-    def __init__(self, bot, save_point, server):
+    def __init__(self, save_point, server_id, index):
+        self.save_point = save_point
+        self.server_id = server_id
+        self.index = index
+        self.entries = {}  # message id -> Entry
+        for post in save_point["MSGS"].values():
+            self._register(Entry(post, server_id))
+
+    def _register(self, entry):
+        self.entries[entry.id] = entry
+        self.index[(entry.id, entry.emoji)] = entry
+
+    def add(self, post):
+        self.save_point["MSGS"][post["ID"]] = post
+        entry = Entry(post, self.server_id)
+        self._register(entry)
+        return entry
+
+    def remove(self, message_id):
+        """drops an entry. returns it, or None if it wasn't on the board"""
+        entry = self.entries.pop(message_id, None)
+        if entry is not None:
+            del self.save_point["MSGS"][message_id]
+            self.index.pop((entry.id, entry.emoji), None)
+        return entry
+
+
+class ServerIndex:
+    """case-folded name -> [objects] for a server's channels and roles,
+    and id -> role. kept current by RoleCall's channel and role events"""
+
+    def __init__(self, server):
+        self.channels = {}
+        self.roles = {}
+        self.role_ids = {}
+        for channel in server.channels:
+            self.add_channel(channel)
+        for role in server.roles:
+            self.add_role(role)
+
+    def add_channel(self, channel):
+        self.channels.setdefault(channel.name.casefold(), []).append(channel)
+
+    def remove_channel(self, channel):
+        _drop(self.channels, channel)
+
+    def add_role(self, role):
+        self.roles.setdefault(role.name.casefold(), []).append(role)
+        self.role_ids[role.id] = role
+
+    def remove_role(self, role):
+        _drop(self.roles, role)
+        self.role_ids.pop(role.id, None)
+
+
+def _drop(names, obj):
+    """removes obj from a ServerIndex name map, going by its id"""
+    key = obj.name.casefold()
+    bucket = [o for o in names.get(key, ()) if o.id != obj.id]
+    if bucket:
+        names[key] = bucket
+    else:
+        names.pop(key, None)
+
+
+class RoleQueue:
+    """Per-server queue of role changes
+
+    changes for a member that come in while the queue is waiting or busy
+    are merged and applied as a single role edit
+    """
+
+    def __init__(self, bot, server_id, index):
+        self.bot = bot
+        self.server_id = server_id
+        self.index = index  # gets the server's ServerIndex
+        # member id -> (role ids to add, role ids to remove, time queued)
+        self.pending = OrderedDict()
+        self.latencies = deque(maxlen=100)
+        self.task = None
+
+    def put(self, member_id, role_id, add):
+        adds, removes, queued = self.pending.setdefault(
+            member_id, (set(), set(), time.time()))
+        if add:
+            adds.add(role_id)
+            removes.discard(role_id)
+        else:
+            removes.add(role_id)
+            adds.discard(role_id)
+        if self.task is None or self.task.done():
+            self.task = self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        try:
+            await asyncio.sleep(ROLE_BATCH_DELAY)
+            while self.pending:
+                member_id, (adds, removes, queued) = self.pending.popitem(last=False)
+                await self._apply(member_id, adds, removes)
+                self.latencies.append(time.time() - queued)
+        except asyncio.CancelledError:
+            pass
+
+    async def _apply(self, member_id, adds, removes):
+        server = self.bot.get_server(self.server_id)
+        member = server and server.get_member(member_id)
+        if member is None:
+            return
+        current = [r for r in member.roles if not r.is_everyone]
+        roles = [r for r in current if r.id not in removes]
+        have = {r.id for r in roles}
+        role_ids = self.index(server).role_ids
+        roles.extend(role_ids[rid] for rid in adds
+                     if rid in role_ids and rid not in have)
+        if len(roles) == len(current) and set(roles) == set(current):
+            return
+        for attempt in range(ROLE_RETRIES):
+            try:
+                await self.bot.replace_roles(member, *roles)
+                return
+            except discord.HTTPException as e:
+                if e.response.status != 429 or attempt == ROLE_RETRIES - 1:
+                    log.warning("couldn't update roles for {}: {}".format(member, e))
+                    return
+                await asyncio.sleep(_retry_after(e.response, attempt))
+
+    def stats(self):
+        """(queue depth, average latency, max latency) of recent edits"""
+        lat = self.latencies
+        avg = sum(lat) / len(lat) if lat else 0
+        return len(self.pending), avg, max(lat, default=0)
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+def _retry_after(response, attempt):
+    """seconds to wait after a 429, from its headers if it has them"""
+    headers = response.headers
+    try:
+        return float(headers["X-RateLimit-Reset-After"])
+    except (KeyError, ValueError):
         pass
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, ValueError):
+        return 2 ** attempt
 
 
 class RoleCall:
@@ -101,6 +300,28 @@ class RoleCall:
     def __init__(self, bot):
         self.bot = bot
         self.settings = dataIO.load_json(SETTINGS_PATH)
+        # (message id, emoji key) -> Entry, for every server
+        self.index = {}
+        self.boards = {sid: RoleBoard(settings, sid, self.index)
+                       for sid, settings in self.settings.items()}
+        self.queues = {}  # server id -> RoleQueue
+        self.indexes = {}  # server id -> ServerIndex, built on first use
+        # message id -> when it was synced, for entries done by a reconcile
+        # pass that hasn't finished. a restarted pass skips them
+        self.checkpoint = dataIO.load_json(CHECKPOINT_PATH)
+        self._role_members = {}  # role id -> member ids, while reconciling
+        self._reconciler = self.bot.loop.create_task(self.reconcile())
+        self.bot.loop.create_task(self.migrate_names())
+
+    def _board(self, server):
+        try:
+            return self.boards[server.id]
+        except KeyError:
+            settings = self.settings.setdefault(server.id,
+                                                deepcopy(DEFAULT_SETTINGS))
+            board = self.boards[server.id] = RoleBoard(settings, server.id,
+                                                       self.index)
+            return board
 
     @commands.group(pass_context=True, no_pm=True)
     async def roleboard(self, ctx):
@@ -110,8 +331,9 @@ class RoleCall:
         if ctx.invoked_subcommand is None:
             await self.bot.send_cmd_help(ctx)
         else:
-            self.settings.setdefault(server.id, deepcopy(DEFAULT_SETTINGS))
+            self._board(server)
 
+    @checks.admin_or_permissions(manage_roles=True)
     @roleboard.command(pass_context=True, name="channel", no_pm=True)
     async def roleboard_channel(self, ctx, channel: discord.Channel=None):
         """Set the roleboard for this server.
@@ -133,36 +355,148 @@ class RoleCall:
 
         if channel is None and not \
            await self.prompt(ctx, "turn off the roleboard? (yes/no)"):
-            if settings["ROLEBOARD"] is None:
-                rb_channel = None
-            else:
-                rb_channel = get_channel_by_name(server, settings["ROLEBOARD"])
+            rb_channel = server.get_channel(settings["ROLEBOARD"])
             await self.bot.say('Ok. Roleboard is still {}'
                                .format(rb_channel and rb_channel.mention))
             return
 
-        settings["ROLEBOARD"] = channel and channel.name
+        settings["ROLEBOARD"] = channel and channel.id
         self._save()
         await self.bot.say('Roleboard is now {}'.format(channel))
 
+    @checks.admin_or_permissions(manage_roles=True)
     @roleboard.command(pass_context=True, name="add", no_pm=True)
-    async def roleboard_add(self, ctx, role_name: str,
-                            content_or_messsage_id: str):
-        """Add an entry to the roleboard."""
+    async def roleboard_add(self, ctx, role: discord.Role, emoji: str, *,
+                            description: str=None):
+        """Add an entry to the roleboard.
+
+        Members who react to it with the emoji get the role
+        and lose it when they take the reaction off.
+        """
         server = ctx.message.server
-        # channel = ctx.message.channel
         author = ctx.message.author
+        settings = self.settings[server.id]
+
+        channel = server.get_channel(settings["ROLEBOARD"])
+        if channel is None:
+            return await self.bot.say("Set the roleboard channel first")
+        if role.is_everyone:
+            return await self.bot.say("Everyone has that role already")
+        if author != server.owner and \
+           role.position >= author.top_role.position:
+            return await self.bot.say("You can only put roles below your "
+                                      "highest role on the roleboard")
+
+        key = emoji_key(emoji)
+        reaction = discord.utils.get(server.emojis, id=key) or emoji
+        embed = discord.Embed(title=role.name,
+                              description=description or discord.Embed.Empty,
+                              colour=role.colour)
+        embed.set_footer(text="React with the emoji below to get this role")
+        message, post = await post_role(self.bot, role, channel, author, key,
+                                        embed=embed)
+        self._board(server).add(post)
+        self._save()
+        try:
+            await self.bot.add_reaction(message, reaction)
+        except discord.HTTPException:
+            await self.bot.say("I couldn't react with that emoji. "
+                               "React to it yourself or use a different emoji")
+        await self.bot.say("Added {} to the roleboard".format(role.name))
+
+    @checks.admin_or_permissions(manage_roles=True)
+    @roleboard.command(pass_context=True, name="remove", no_pm=True)
+    async def roleboard_remove(self, ctx, message_id: str):
+        """Take an entry off the roleboard. Nobody loses the role"""
+        server = ctx.message.server
+        entry = self._board(server).remove(message_id)
+        if entry is None:
+            return await self.bot.say("That message isn't on the roleboard")
+        self._save()
+        channel = server.get_channel(entry.channel_id)
+        try:
+            message = await self.bot.get_message(channel, entry.id)
+            await self.bot.delete_message(message)
+        except (discord.HTTPException, AttributeError):
+            pass  # already gone
+        await self.bot.say("Entry removed")
+
+    @roleboard.command(pass_context=True, name="list", no_pm=True)
+    async def roleboard_list(self, ctx):
+        """List the roleboard entries"""
+        server = ctx.message.server
+        board = self._board(server)
+        if not board.entries:
+            return await self.bot.say("The roleboard is empty")
+        lines = []
+        for entry in board.entries.values():
+            role = self._index(server).role_ids.get(entry.role_id)
+            emoji = discord.utils.get(server.emojis, id=entry.emoji) or entry.emoji
+            lines.append("{} {} ({})".format(emoji, role and role.name,
+                                             entry.id))
+        await self.bot.say("\n".join(lines))
+
+    async def on_reaction_add(self, reaction, user):
+        await self._on_reaction(reaction, user, True)
+
+    async def on_reaction_remove(self, reaction, user):
+        await self._on_reaction(reaction, user, False)
+
+    async def _on_reaction(self, reaction, user, add):
+        message = reaction.message
+        entry = self.index.get((message.id, emoji_key(reaction.emoji)))
+        if entry is None or user.bot:
+            return
+        self._queue(message.server.id).put(user.id, entry.role_id, add)
 
-        channel = channel or role_name.lower()
+    async def on_socket_raw_receive(self, msg):
+        """discord.py only dispatches reactions on messages in its cache,
+        which old roleboard messages fall out of. those are read off the
+        gateway here instead
 
-        role_name = self.get_or_create("role", role_name)
+        a message evicted between discord.py handling the event and this
+        running gets the change queued twice, which RoleQueue merges
+        """
+        if isinstance(msg, bytes):  # compressed, same as discord.py gets it
+            msg = zlib.decompress(msg, 15, 10490000).decode('utf-8')
+        if '"MESSAGE_REACTION_' not in msg:
+            return
+        event = json.loads(msg)
+        add = RAW_REACTIONS.get(event.get("t"))
+        if add is None:
+            return
+        data = event["d"]
+        emoji = data["emoji"]
+        entry = self.index.get((data["message_id"], emoji["id"] or emoji["name"]))
+        if entry is None or discord.utils.get(self.bot.messages, id=entry.id):
+            return  # not on a roleboard, or on_reaction_add/remove has it
+        server = self.bot.get_server(entry.server_id)
+        member = server and server.get_member(data["user_id"])
+        if member is None or member.bot:
+            return
+        self._queue(server.id).put(member.id, entry.role_id, add)
 
-        description = ("called **#{}** that only people with the {} role "
-                       "can access?".format(channel, role_name.mention))
-        embed = discord.Embed(title="Create a Channel?",
-                              description=description)
-        embed.set_footer(text="*or type a different channel name or the name of an existing channel to link that channel instead.")
-        await self.prompt(ctx, embed=embed)
+    def _queue(self, server_id):
+        try:
+            return self.queues[server_id]
+        except KeyError:
+            queue = self.queues[server_id] = RoleQueue(self.bot, server_id,
+                                                       self._index)
+            return queue
+
+    @roleboard.command(pass_context=True, name="queue", no_pm=True)
+    async def roleboard_queue(self, ctx):
+        """How backed up role changes are in this server"""
+        depth, avg, worst = self._queue(ctx.message.server.id).stats()
+        await self.bot.say("{} members waiting. Recent role changes took {:.1f}s "
+                           "on average, {:.1f}s at worst".format(depth, avg, worst))
+
+    async def on_message_delete(self, message):
+        if message.server is None or message.server.id not in self.boards:
+            return
+        if self.boards[message.server.id].remove(message.id) is not None:
+            self.checkpoint.pop(message.id, None)
+            self._save()
 
     async def prompt(self, ctx, *args, **kwargs):
         """prompts author with a message (yes/no)
@@ -194,6 +528,92 @@ class RoleCall:
     def _save(self):
         return dataIO.save_json(SETTINGS_PATH, self.settings)
 
+    def __unload(self):
+        self._reconciler.cancel()
+        for queue in self.queues.values():
+            queue.cancel()
+
+    async def reconcile(self):
+        """gives roles to people who reacted to the roleboard
+        while the bot was offline
+
+        only adds roles. someone with the role and no reaction may have
+        gotten it some other way, so they're left alone
+
+        entries are checkpointed as they're done, so a pass cut short by a
+        restart picks up where it left off. those entries miss whatever was
+        reacted during the restart itself
+        """
+        await self.bot.wait_until_ready()
+        try:
+            todo = asyncio.Queue()
+            for board in self.boards.values():
+                for entry in board.entries.values():
+                    todo.put_nowait(entry)
+            if not todo.empty():
+                log.info("loading {} roleboard entries".format(todo.qsize()))
+                # a role's members are only gathered once, for every entry using it
+                self._role_members = {}
+                await asyncio.gather(*[self._reconcile_worker(todo)
+                                       for _ in range(RECONCILE_WORKERS)])
+            # the pass is complete. the next startup checks everything again
+            self.checkpoint.clear()
+            dataIO.save_json(CHECKPOINT_PATH, self.checkpoint)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._role_members = {}
+
+    async def _reconcile_worker(self, todo):
+        while not todo.empty():
+            entry = todo.get_nowait()
+            try:
+                synced = await self._reconcile_entry(entry)
+            except discord.HTTPException as e:
+                log.warning("couldn't reconcile roleboard entry {}: {}"
+                            .format(entry.id, e))
+                continue
+            if synced:
+                self.checkpoint[entry.id] = time.time()
+                dataIO.save_json(CHECKPOINT_PATH, self.checkpoint)
+
+    async def _reconcile_entry(self, entry):
+        """returns whether the entry's reactions were synced with its role"""
+        server = self.bot.get_server(entry.server_id)
+        channel = server and server.get_channel(entry.channel_id)
+        role = server and self._index(server).role_ids.get(entry.role_id)
+        if channel is None or role is None:
+            return False
+        if entry.id in self.checkpoint:  # done before the last restart
+            return False
+        message = await self.bot.get_message(channel, entry.id)
+        reaction = discord.utils.find(lambda r: emoji_key(r.emoji) == entry.emoji,
+                                      message.reactions)
+        if reaction is None:
+            return True
+
+        members = self._role_members.get(role.id)
+        if members is None:
+            members = {m.id for m in server.members if role in m.roles}
+            self._role_members[role.id] = members
+
+        reacted = []
+        after = None
+        while True:
+            users = await self.bot.get_reaction_users(reaction, limit=100,
+                                                      after=after)
+            reacted.extend(u.id for u in users if not u.bot)
+            if len(users) < 100:
+                break
+            after = users[-1]
+
+        queue = self._queue(server.id)
+        for uid in reacted:
+            if uid not in members and server.get_member(uid) is not None:
+                members.add(uid)
+                queue.put(uid, role.id, True)
+        return True
+
     def _get_object_by_name(self, otype, server, name, ignore_case=True):
         """returns object of specified type from server of specified name
         otype is discord.Role or discord.Channel
@@ -202,15 +622,74 @@ class RoleCall:
             discord.Role: 'roles',
             discord.Channel: 'channels'
         }
-        li = getattr(server, types[otype])
+        li = getattr(self._index(server), types[otype]).get(name.casefold(), ())
         if ignore_case:
-            match = [i for i in li if i.name.lower() == name.lower()]
+            match = li
         else:
             match = [i for i in li if i.name == name]
         if len(match) > 1:
             raise Exception("More than one {} found".format(types[otype][:-1]))
         return match[0]
 
+    def _index(self, server):
+        try:
+            return self.indexes[server.id]
+        except KeyError:
+            index = self.indexes[server.id] = ServerIndex(server)
+            return index
+
+    async def migrate_names(self):
+        """ROLEBOARD used to be a channel name. switch those to ids"""
+        await self.bot.wait_until_ready()
+        changed = False
+        for sid, settings in self.settings.items():
+            server = self.bot.get_server(sid)
+            name = settings["ROLEBOARD"]
+            if server is None or name is None or server.get_channel(name):
+                continue
+            try:
+                channel = get_channel_by_name(self._index(server), name)
+            except (NoChannelWithThatName, MultipleChannelsWithThatName) as e:
+                log.warning("couldn't migrate the roleboard for {}: {}"
+                            .format(server.name, e))
+                continue
+            settings["ROLEBOARD"] = channel.id
+            changed = True
+        if changed:
+            self._save()
+
+    # keep the indexes of servers that have one current
+
+    async def on_channel_create(self, channel):
+        if not channel.is_private and channel.server.id in self.indexes:
+            self.indexes[channel.server.id].add_channel(channel)
+
+    async def on_channel_delete(self, channel):
+        if not channel.is_private and channel.server.id in self.indexes:
+            self.indexes[channel.server.id].remove_channel(channel)
+
+    async def on_channel_update(self, before, after):
+        if not after.is_private and after.server.id in self.indexes:
+            index = self.indexes[after.server.id]
+            index.remove_channel(before)
+            index.add_channel(after)
+
+    async def on_server_role_create(self, role):
+        if role.server.id in self.indexes:
+            self.indexes[role.server.id].add_role(role)
+
+    async def on_server_role_delete(self, role):
+        if role.server.id in self.indexes:
+            self.indexes[role.server.id].remove_role(role)
+
+    async def on_server_role_update(self, before, after):
+        if after.server.id in self.indexes:
+            index = self.indexes[after.server.id]
+            index.remove_role(before)
+            index.add_role(after)
+
+    async def on_server_remove(self, server):
+        self.indexes.pop(server.id, None)
 
 
 async def wait_for_first_response(tasks, converters):
@@ -251,6 +730,9 @@ def check_folders():
 def check_files():
     default = {}
 
+    if not dataIO.is_valid_json(CHECKPOINT_PATH):
+        dataIO.save_json(CHECKPOINT_PATH, {})
+
     if not dataIO.is_valid_json(SETTINGS_PATH):
         print("Creating default rolecall settings.json...")
         dataIO.save_json(SETTINGS_PATH, default)